@@ -0,0 +1,190 @@
+# This is a set of scripts that are used in the Citi Bike Voila dashboard (index.ipynb)
+
+import asyncio
+import numpy as np
+import pandas as pd
+
+def make_in_out_tables(df_gex):
+    '''
+    Precompute the marker opacities and colors of every station for inbound
+    (matrix rows) and outbound (matrix columns) paths. Arrays are aligned to
+    the matrix columns (the order of the scatter markers), e.g. row i of
+    'in-opacity' has the marker opacities for inbound paths to station i.
+    '''
+    stations = df_gex.columns.tolist()
+
+    # use the column order for rows so that both directions are aligned
+    mat = df_gex.loc[stations, stations].values.astype(np.float32)
+
+    tables = {}
+    tables['stations'] = stations
+    tables['station_index'] = dict((value, idx) for idx, value in enumerate(stations))
+
+    # red: more riders, blue: fewer riders, black: selected station
+    tables['palette'] = np.array(['red', 'blue', 'black'])
+
+    for inst_direction, inst_mat in [('in', mat), ('out', mat.transpose())]:
+
+        # normalize by the max of each station (skipping NaNs, all NaN rows stay NaN)
+        row_max = np.full((inst_mat.shape[0], 1), np.nan, dtype=np.float32)
+        has_values = ~np.isnan(inst_mat).all(axis=1)
+        row_max[has_values, 0] = np.nanmax(inst_mat[has_values], axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mat_norm = inst_mat / np.abs(row_max)
+
+        # opacities need to be between zero and one
+        mat_opacity = np.nan_to_num(np.clip(np.abs(mat_norm), 0, 1)).astype(np.float32)
+        mat_color = np.where(mat_norm >= 0, 0, 1).astype(np.uint8)
+
+        np.fill_diagonal(mat_opacity, 1.0)
+        np.fill_diagonal(mat_color, 2)
+
+        tables[inst_direction + '-opacity'] = mat_opacity
+        tables[inst_direction + '-color'] = mat_color
+
+    return tables
+
+def get_in_out_markers(tables, inst_marker, inst_direction):
+    '''
+    Look up the marker opacities and colors for inbound ('in') or outbound
+    ('out') paths of a station (see make_in_out_tables).
+    '''
+    inst_index = tables['station_index'][inst_marker]
+
+    list_opacities = tables[inst_direction + '-opacity'][inst_index].tolist()
+    list_marker_colors = tables['palette'][tables[inst_direction + '-color'][inst_index]].tolist()
+
+    return list_opacities, list_marker_colors
+
+def make_cat_index(df_meta, stations):
+    '''
+    Index station categories once at load time. For each category title the
+    stations (in marker order) are stored as integer category codes and
+    (title, value) pairs are mapped to their code, values are looked up as
+    strings (the way they appear in the clustergrammer2 category labels).
+    The positions of df_meta rows in the marker order are also saved for
+    dendrogram selections (which use df_meta positions).
+    '''
+    df_cats = df_meta.loc[stations]
+
+    cat_index = {}
+    cat_index['num_stations'] = len(stations)
+    cat_index['codes'] = {}
+    cat_index['lookup'] = {}
+
+    for inst_cat_title in df_cats.columns:
+        cat_codes, cat_values = pd.factorize(df_cats[inst_cat_title].astype(str))
+        cat_index['codes'][inst_cat_title] = cat_codes.astype(np.int32)
+
+        for inst_code, inst_value in enumerate(cat_values):
+            cat_index['lookup'][(inst_cat_title, inst_value)] = inst_code
+
+    cat_index['meta_positions'] = pd.Index(stations).get_indexer(df_meta.index)
+
+    return cat_index
+
+def get_cat_mask(cat_index, inst_cat_title, inst_cat):
+    '''
+    Boolean mask (marker order) of stations that have a category value.
+    '''
+    if (inst_cat_title, inst_cat) not in cat_index['lookup']:
+        return np.zeros(cat_index['num_stations'], dtype=bool)
+
+    inst_code = cat_index['lookup'][(inst_cat_title, inst_cat)]
+
+    return cat_index['codes'][inst_cat_title] == inst_code
+
+def get_dendro_mask(cat_index, found_indexes):
+    '''
+    Boolean mask (marker order) of stations selected in the dendrogram
+    (found_indexes are positions in df_meta).
+    '''
+    meta_positions = cat_index['meta_positions']
+
+    found_positions = meta_positions[np.asarray(found_indexes, dtype=np.int64)]
+
+    mask = np.zeros(cat_index['num_stations'], dtype=bool)
+    mask[found_positions[found_positions >= 0]] = True
+
+    return mask
+
+class FrameScheduler(object):
+    '''
+    Coalesce rapid widget events and scatter updates into one update per
+    frame. Only the latest event of a frame is handled (superseded events are
+    dropped) and the resulting marker colors, opacities, and figure title are
+    sent together, with the scatter updates inside a single hold_sync.
+    '''
+
+    def __init__(self, scatter, fig, frame_time=0.05):
+        self.scatter = scatter
+        self.fig = fig
+        self.frame_time = frame_time
+
+        self.pending_event = None
+        self.pending_update = {}
+        self.handle = None
+        self.flushing = False
+
+    def observe(self, handler):
+        '''
+        Wrap a traitlets observe handler so that it only runs on the latest
+        change of each frame.
+        '''
+        def on_change(change):
+            self.pending_event = (handler, change)
+            self.schedule()
+
+        return on_change
+
+    def update(self, colors=None, opacities=None, title=None):
+        '''
+        Request scatter colors, opacities, and/or a figure title, these replace
+        earlier requests of the same frame.
+        '''
+        if colors is not None:
+            self.pending_update['colors'] = colors
+        if opacities is not None:
+            self.pending_update['default_opacities'] = opacities
+        if title is not None:
+            self.pending_update['title'] = title
+
+        if not self.flushing:
+            self.schedule()
+
+    def get_title(self):
+        '''
+        Figure title including a pending title update.
+        '''
+        return self.pending_update.get('title', self.fig.title)
+
+    def schedule(self):
+        if self.handle is None:
+            loop = asyncio.get_event_loop()
+            self.handle = loop.call_later(self.frame_time, self.flush)
+
+    def flush(self):
+        '''
+        Handle the latest event and send all pending updates.
+        '''
+        self.handle = None
+        self.flushing = True
+
+        try:
+            if self.pending_event is not None:
+                handler, change = self.pending_event
+                self.pending_event = None
+                handler(change)
+        finally:
+            self.flushing = False
+
+        inst_update = self.pending_update
+        self.pending_update = {}
+
+        if 'title' in inst_update and inst_update['title'] != self.fig.title:
+            self.fig.title = inst_update['title']
+
+        with self.scatter.hold_sync():
+            for inst_trait in ['colors', 'default_opacities']:
+                if inst_trait in inst_update and inst_update[inst_trait] != getattr(self.scatter, inst_trait):
+                    setattr(self.scatter, inst_trait, inst_update[inst_trait])
@@ -0,0 +1,860 @@
+# This is a set of scripts that are used in processing Citi Bike trip data
+
+import pandas as pd
+import numpy as np
+from scipy import sparse
+import hashlib
+import json
+import os
+import pickle
+
+def get_station_codes(ser_station, all_stations):
+    '''
+    Convert a series of station names to integer codes (position in
+    all_stations). Stations that are not in all_stations get the code -1.
+    '''
+    inst_cat = pd.Categorical(ser_station, categories=all_stations)
+    return np.asarray(inst_cat.codes, dtype=np.int64)
+
+def bincount_sum_and_count(codes, values, num_stations):
+    '''
+    Sum values and count non-null values for each station code in a single
+    pass. Rows with code -1 or null values are ignored.
+    '''
+    values = np.asarray(values, dtype=np.float64)
+    keep = (codes >= 0) & ~np.isnan(values)
+
+    arr_sum = np.bincount(codes[keep], weights=values[keep], minlength=num_stations)
+    arr_count = np.bincount(codes[keep], minlength=num_stations)
+
+    return arr_sum, arr_count
+
+def calc_birth_year_hist(codes, birth_year, num_stations, min_year=1880, max_year=2030):
+    '''
+    Count rides for each station and birth year (stations x birth years from
+    min_year to max_year). Birth years outside of this range are ignored.
+    '''
+    num_years = max_year - min_year + 1
+    year_codes = np.asarray(birth_year, dtype=np.float64) - min_year
+    keep = (codes >= 0) & (year_codes >= 0) & (year_codes < num_years)
+
+    flat_codes = codes[keep] * num_years + year_codes[keep].astype(np.int64)
+    year_hist = np.bincount(flat_codes, minlength=num_stations * num_years)
+
+    return year_hist.reshape(num_stations, num_years)
+
+def calc_station_sums(df_ini, all_stations, to_sparse=False):
+    '''
+    Calculate origin-destination counts and per-station coordinate and birth
+    year sums from a DataFrame of rides in a single pass. Returns a dictionary
+    of numpy arrays that are aligned to all_stations (the origin-destination
+    counts are a csc matrix if to_sparse=True).
+    '''
+    num_stations = len(all_stations)
+
+    start_codes = get_station_codes(df_ini['start station name'], all_stations)
+    end_codes = get_station_codes(df_ini['end station name'], all_stations)
+
+    # origin-destination counts (rows are destinations, cols are origins)
+    ######################################################################
+    keep = (start_codes >= 0) & (end_codes >= 0)
+
+    station_sums = {}
+    if to_sparse:
+        # duplicate (destination, origin) pairs are summed
+        arr_ones = np.ones(keep.sum(), dtype=np.int64)
+        station_sums['od'] = sparse.coo_matrix((arr_ones, (end_codes[keep], start_codes[keep])),
+                                               shape=(num_stations, num_stations)).tocsc()
+    else:
+        flat_codes = end_codes[keep] * num_stations + start_codes[keep]
+        od_counts = np.bincount(flat_codes, minlength=num_stations**2)
+        station_sums['od'] = od_counts.reshape(num_stations, num_stations)
+
+    # number of rides departing from and arriving at each station
+    station_sums['depart-count'] = np.bincount(start_codes[start_codes >= 0], minlength=num_stations)
+    station_sums['arrive-count'] = np.bincount(end_codes[end_codes >= 0], minlength=num_stations)
+
+    # start station coordinates
+    ############################
+    for inst_coord in ['latitude', 'longitude']:
+        inst_sum, inst_count = bincount_sum_and_count(start_codes,
+                                   df_ini['start station ' + inst_coord],
+                                   num_stations)
+        station_sums[inst_coord + '-sum'] = inst_sum
+        station_sums[inst_coord + '-count'] = inst_count
+
+    # birth year of departing and arriving riders
+    ###############################################
+    for inst_point, inst_codes in [('depart', start_codes), ('arrive', end_codes)]:
+        inst_sum, inst_count = bincount_sum_and_count(inst_codes,
+                                   df_ini['birth year'], num_stations)
+        station_sums[inst_point + '-year-sum'] = inst_sum
+        station_sums[inst_point + '-year-count'] = inst_count
+        station_sums[inst_point + '-year-hist'] = calc_birth_year_hist(inst_codes,
+                                                      df_ini['birth year'], num_stations)
+
+    return station_sums
+
+def pad_station_sums(station_sums, num_stations):
+    '''
+    Pad station sums with zeros so that they cover num_stations stations (new
+    stations are appended to the end).
+    '''
+    padded_sums = {}
+    for inst_key in station_sums:
+        inst_arr = station_sums[inst_key]
+        num_pad = num_stations - inst_arr.shape[0]
+        if sparse.issparse(inst_arr):
+            padded_sums[inst_key] = sparse.csc_matrix((inst_arr.data, inst_arr.indices,
+                                                       np.pad(inst_arr.indptr, (0, num_pad), mode='edge')),
+                                                      shape=(num_stations, num_stations))
+        else:
+            # only the od matrix has stations on both axes
+            pad_width = [(0, num_pad)] + [(0, num_pad if inst_key == 'od' else 0)] * (inst_arr.ndim - 1)
+            padded_sums[inst_key] = np.pad(inst_arr, pad_width, mode='constant')
+
+    return padded_sums
+
+def add_station_sums(station_sums, new_sums):
+    '''
+    Add two sets of station sums, stations are matched by position and the
+    smaller set is padded with zeros.
+    '''
+    if station_sums is None:
+        return new_sums
+
+    num_stations = max(station_sums['od'].shape[0], new_sums['od'].shape[0])
+    station_sums = pad_station_sums(station_sums, num_stations)
+    new_sums = pad_station_sums(new_sums, num_stations)
+
+    return {inst_key: station_sums[inst_key] + new_sums[inst_key] for inst_key in station_sums}
+
+def subset_station_sums(station_sums, station_indexes):
+    '''
+    Reorder/subset station sums using a list of station positions.
+    '''
+    station_indexes = np.asarray(station_indexes, dtype=np.int64)
+
+    sub_sums = {}
+    for inst_key in station_sums:
+        inst_arr = station_sums[inst_key]
+        if sparse.issparse(inst_arr):
+            sub_sums[inst_key] = inst_arr[station_indexes, :][:, station_indexes]
+        elif inst_key == 'od':
+            sub_sums[inst_key] = inst_arr[np.ix_(station_indexes, station_indexes)]
+        else:
+            sub_sums[inst_key] = inst_arr[station_indexes]
+
+    return sub_sums
+
+def station_sums_to_df(station_sums, all_stations, inst_year=2020, mean_age=40):
+    '''
+    Convert station sums (see calc_station_sums) to the destination matrix
+    (df_dest) and a DataFrame of station positions and average ages. If the
+    origin-destination counts are sparse the destination matrix is returned in
+    feature_data format (dictionary with 'mat', 'features', and 'barcodes').
+    '''
+    if sparse.issparse(station_sums['od']):
+        df_dest = {}
+        df_dest['mat'] = sparse.csc_matrix(station_sums['od'], dtype=np.float64)
+        df_dest['features'] = list(all_stations)
+        df_dest['barcodes'] = list(all_stations)
+    else:
+        df_dest = pd.DataFrame(station_sums['od'].astype(np.float64),
+                               index=all_stations, columns=all_stations)
+
+    # stations without rides get a NaN mean
+    with np.errstate(divide='ignore', invalid='ignore'):
+
+        df_station = pd.DataFrame(index=all_stations)
+
+        for inst_coord in ['latitude', 'longitude']:
+            df_station['start station ' + inst_coord] = (station_sums[inst_coord + '-sum'] /
+                                                         station_sums[inst_coord + '-count'])
+
+        for inst_point, inst_name in [('depart', 'departing'), ('arrive', 'arriving')]:
+            mean_year = (station_sums[inst_point + '-year-sum'] /
+                         station_sums[inst_point + '-year-count'])
+            df_station[inst_name + ' age'] = inst_year - mean_year - mean_age
+
+    return df_dest, df_station
+
+def make_od_matrix(df_ini, inst_year=2020, mean_age=40, all_stations=None, to_sparse=False):
+    '''
+    Make the station origin-destination matrix (destination rows, origin
+    columns) and station metadata (mean start latitude/longitude, departing
+    and arriving age) using integer station codes and bincount instead of
+    filtering all rides once per station. Use to_sparse=True to get the
+    matrix as a sparse feature_data dictionary (see station_sums_to_df).
+    '''
+    if all_stations is None:
+        all_stations = sorted(df_ini['start station name'].dropna().unique().tolist())
+
+    station_sums = calc_station_sums(df_ini, all_stations, to_sparse=to_sparse)
+    df_dest, df_station = station_sums_to_df(station_sums, all_stations,
+                                             inst_year=inst_year, mean_age=mean_age)
+
+    return df_dest, df_station
+
+def year_hist_to_age_df(station_sums, all_stations, inst_year=2020, points=['depart', 'arrive'],
+                        min_year=1880):
+    '''
+    Convert station birth year histograms (see calc_birth_year_hist) to a
+    DataFrame of rider ages (rows, e.g. '35_Depart') by station (columns).
+    Only ages with rides are kept and rows are sorted by age.
+    '''
+    list_df = []
+    for inst_point in points:
+        year_hist = station_sums[inst_point + '-year-hist']
+        birth_years = min_year + np.arange(year_hist.shape[1])
+
+        # sort by age (youngest first)
+        keep_years = np.where(year_hist.sum(axis=0) > 0)[0][::-1]
+        ages = inst_year - birth_years[keep_years]
+
+        inst_df = pd.DataFrame(year_hist[:, keep_years].transpose().astype(np.float64),
+                               index=[str(x) + '_' + inst_point.capitalize() for x in ages],
+                               columns=all_stations)
+        list_df.append(inst_df)
+
+    df_age = pd.concat(list_df, axis=0)
+
+    return df_age
+
+def make_age_matrix(df_ini, inst_year=2020, all_stations=None, points=['depart', 'arrive'],
+                    min_year=None, max_year=None):
+    '''
+    Make the rider age (rows) by station (columns) count matrix for departing
+    and/or arriving rides in one pass over the rides. Birth years outside of
+    min_year to max_year are excluded, by default the range is taken from
+    the data so that all rides with a birth year are counted.
+    '''
+    if all_stations is None:
+        all_stations = sorted(df_ini['start station name'].dropna().unique().tolist())
+
+    num_stations = len(all_stations)
+
+    birth_year = np.asarray(df_ini['birth year'], dtype=np.float64)
+    has_year = ~np.isnan(birth_year)
+    if min_year is None:
+        min_year = int(np.floor(birth_year[has_year].min())) if has_year.any() else 1880
+    if max_year is None:
+        max_year = int(birth_year[has_year].max()) if has_year.any() else min_year
+
+    station_sums = {}
+    for inst_point in points:
+        inst_col = ('start' if inst_point == 'depart' else 'end') + ' station name'
+        inst_codes = get_station_codes(df_ini[inst_col], all_stations)
+        station_sums[inst_point + '-year-hist'] = calc_birth_year_hist(inst_codes, birth_year, num_stations,
+                                                                       min_year=min_year, max_year=max_year)
+
+    df_age = year_hist_to_age_df(station_sums, all_stations, inst_year=inst_year, points=points,
+                                 min_year=min_year)
+
+    return df_age
+
+def umi_norm_sparse(od_data):
+    '''
+    Sparse version of net.umi_norm, divide each column (origin station) by
+    its sum. Returns a new feature_data dictionary that shares the labels.
+    '''
+    mat = od_data['mat']
+    arr_sum = np.asarray(mat.sum(axis=0)).ravel()
+
+    # leave empty columns as zeros
+    arr_scale = np.zeros(arr_sum.shape[0])
+    arr_scale[arr_sum > 0] = 1.0 / arr_sum[arr_sum > 0]
+
+    norm_data = {}
+    norm_data['mat'] = sparse.csc_matrix(mat.dot(sparse.diags(arr_scale)))
+    norm_data['features'] = od_data['features']
+    norm_data['barcodes'] = od_data['barcodes']
+
+    return norm_data
+
+def read_trip_chunks(trip_files, chunksize=500000):
+    '''
+    Read one or more monthly trip files in chunks of rides, only loading the
+    columns that are needed to calculate station sums.
+    '''
+    if isinstance(trip_files, str):
+        trip_files = [trip_files]
+
+    use_cols = ['start station name', 'start station latitude', 'start station longitude',
+                'end station name', 'birth year']
+
+    for inst_file in trip_files:
+
+        # columnar trip cache (see make_trip_cache)
+        if inst_file.endswith('.parquet'):
+            import pyarrow.parquet as pq
+            parquet_file = pq.ParquetFile(inst_file)
+            for inst_batch in parquet_file.iter_batches(batch_size=chunksize, columns=use_cols):
+                yield inst_batch.to_pandas()
+
+        else:
+            for df_chunk in pd.read_csv(inst_file, usecols=use_cols, chunksize=chunksize):
+                yield df_chunk
+
+def stream_station_sums(trip_files, chunksize=500000, to_sparse=False):
+    '''
+    Calculate station sums (see calc_station_sums) from one or more monthly
+    trip files. Each chunk of rides is folded into running station sums so
+    that memory use does not depend on the number of rides. Returns the
+    station sums and all (start or end) stations sorted by name.
+    '''
+    # station name -> position in running station sums
+    station_index = {}
+    station_sums = None
+
+    for df_chunk in read_trip_chunks(trip_files, chunksize=chunksize):
+
+        # register new start and end stations
+        chunk_names = pd.concat([df_chunk['start station name'],
+                                 df_chunk['end station name']]).dropna().unique()
+        for inst_station in chunk_names:
+            if inst_station not in station_index:
+                station_index[inst_station] = len(station_index)
+
+        chunk_sums = calc_station_sums(df_chunk, list(station_index), to_sparse=to_sparse)
+        station_sums = add_station_sums(station_sums, chunk_sums)
+
+    all_stations = sorted(station_index)
+    station_sums = subset_station_sums(station_sums, [station_index[x] for x in all_stations])
+
+    return station_sums, all_stations
+
+def keep_departing_stations(station_sums, all_stations):
+    '''
+    Only keep stations with departing rides (stations of the notebook
+    destination matrix).
+    '''
+    keep_indexes = np.where(station_sums['depart-count'] > 0)[0]
+    station_sums = subset_station_sums(station_sums, keep_indexes)
+    all_stations = [all_stations[x] for x in keep_indexes]
+
+    return station_sums, all_stations
+
+def stream_od_matrix(trip_files, inst_year=2020, mean_age=40, chunksize=500000,
+                     to_sparse=False):
+    '''
+    Make the origin-destination matrix and station metadata (see
+    make_od_matrix) from one or more monthly trip files, with memory use that
+    does not depend on the number of rides (see stream_station_sums).
+    '''
+    station_sums, all_stations = stream_station_sums(trip_files, chunksize=chunksize,
+                                                     to_sparse=to_sparse)
+    station_sums, all_stations = keep_departing_stations(station_sums, all_stations)
+
+    df_dest, df_station = station_sums_to_df(station_sums, all_stations,
+                                             inst_year=inst_year, mean_age=mean_age)
+
+    return df_dest, df_station
+
+def calc_station_crossings(stations):
+    '''
+    Parse station names (e.g. '1 Ave & E 110 St') into cross streets
+    (cross-y, cross-x) and find the Street (St) and Avenue (Ave) using
+    vectorized string operations. Stations without an Avenue or Street get
+    'N.A.'.
+    '''
+    ser_names = pd.Series(stations, index=stations, dtype=object).astype(str)
+
+    # cross streets, stations without '&' use the full name for both
+    ser_cross = ser_names.str.contains('&', regex=False)
+    ser_parts = ser_names.str.split(' & ')
+    ser_y = ser_parts.str[0].where(ser_cross, ser_names)
+    ser_x = ser_parts.str[1].where(ser_cross, ser_names).fillna(ser_names)
+
+    df_cross = pd.DataFrame(index=ser_names.index)
+    df_cross['station crossing'] = ser_names
+    df_cross['cross-y'] = ser_y
+    df_cross['cross-x'] = ser_x
+
+    # Street and Avenue (cross-y is checked first)
+    for inst_name, inst_search in [('St', ' St'), ('Ave', ' Ave')]:
+        ser_found = ser_x.where(ser_x.str.contains(inst_search, regex=False), 'N.A.')
+        ser_found = ser_y.where(ser_y.str.contains(inst_search, regex=False), ser_found)
+        df_cross[inst_name] = ser_found
+
+    return df_cross
+
+def parse_station_names(stations, cache_file=None):
+    '''
+    Make station metadata from station names (see calc_station_crossings).
+    If cache_file is given previously parsed stations are loaded from the
+    cache and only new stations are parsed (and added to the cache).
+    '''
+    if cache_file is not None and os.path.exists(cache_file):
+        df_cache = pd.read_csv(cache_file, index_col=0, keep_default_na=False)
+    else:
+        df_cache = None
+
+    if df_cache is None:
+        new_stations = list(stations)
+    else:
+        new_stations = [x for x in pd.unique(np.asarray(stations, dtype=object))
+                        if x not in df_cache.index]
+
+    if len(new_stations) > 0:
+        df_new = calc_station_crossings(new_stations)
+        df_cache = df_new if df_cache is None else pd.concat([df_cache, df_new])
+
+        if cache_file is not None:
+            df_cache.to_csv(cache_file)
+
+    return df_cache.loc[list(stations)]
+
+def compact_trip_dtypes(df_trips):
+    '''
+    Convert trip columns to compact dtypes: station names and user types
+    become categoricals (dictionary encoded in parquet), times become
+    datetimes, integers (and floats that only hold whole numbers) are
+    downcast, and other floats (e.g. coordinates) are stored as float32.
+    '''
+    for inst_col in df_trips.columns:
+        inst_ser = df_trips[inst_col]
+
+        if inst_col in ['starttime', 'stoptime']:
+            df_trips[inst_col] = pd.to_datetime(inst_ser)
+
+        elif inst_ser.dtype == object:
+            df_trips[inst_col] = inst_ser.astype('category')
+
+        elif inst_ser.dtype.kind in 'iu':
+            df_trips[inst_col] = pd.to_numeric(inst_ser, downcast='integer')
+
+        elif inst_ser.dtype.kind == 'f':
+            # only downcast floats to integers if they hold whole numbers
+            # (ids and years are read as floats if they have missing values)
+            if inst_ser.notnull().all() and (inst_ser % 1 == 0).all():
+                df_trips[inst_col] = pd.to_numeric(inst_ser.astype(np.int64), downcast='integer')
+            else:
+                df_trips[inst_col] = inst_ser.astype(np.float32)
+
+    return df_trips
+
+def make_trip_cache(trip_file, cache_file=None, overwrite=False):
+    '''
+    One-time conversion of a raw monthly trip CSV to a columnar (parquet)
+    cache with compact dtypes. The cache is only rebuilt if it is older than
+    the CSV (or overwrite=True). Returns the cache filename.
+    '''
+    if cache_file is None:
+        cache_file = os.path.splitext(trip_file)[0] + '.parquet'
+
+    if overwrite or not os.path.exists(cache_file) or \
+       os.path.getmtime(cache_file) < os.path.getmtime(trip_file):
+
+        # read station names directly as categoricals
+        df_trips = pd.read_csv(trip_file, dtype={'start station name': 'category',
+                                                 'end station name': 'category',
+                                                 'usertype': 'category'})
+        df_trips = compact_trip_dtypes(df_trips)
+        df_trips.to_parquet(cache_file, index=False)
+
+        print('cached', trip_file, df_trips.shape)
+
+    return cache_file
+
+def load_trip_cache(cache_file, columns=None):
+    '''
+    Load a columnar trip cache (see make_trip_cache), optionally loading only
+    a subset of columns.
+    '''
+    return pd.read_parquet(cache_file, columns=columns)
+
+def expand_station_sums(station_sums, station_indexes, num_stations):
+    '''
+    Place station sums into a larger set of num_stations stations using the
+    position of each station in the larger set (inverse of subset_station_sums).
+    '''
+    station_indexes = np.asarray(station_indexes, dtype=np.int64)
+
+    full_sums = {}
+    for inst_key in station_sums:
+        inst_arr = station_sums[inst_key]
+        if sparse.issparse(inst_arr):
+            inst_coo = inst_arr.tocoo()
+            full_sums[inst_key] = sparse.coo_matrix((inst_coo.data,
+                                                     (station_indexes[inst_coo.row],
+                                                      station_indexes[inst_coo.col])),
+                                                    shape=(num_stations, num_stations)).tocsc()
+        elif inst_key == 'od':
+            full_arr = np.zeros((num_stations, num_stations), dtype=inst_arr.dtype)
+            full_arr[np.ix_(station_indexes, station_indexes)] = inst_arr
+            full_sums[inst_key] = full_arr
+        else:
+            full_arr = np.zeros((num_stations,) + inst_arr.shape[1:], dtype=inst_arr.dtype)
+            full_arr[station_indexes] = inst_arr
+            full_sums[inst_key] = full_arr
+
+    return full_sums
+
+def get_od_store_months(store_dir):
+    '''
+    List the months (e.g. '201907') that are saved in an OD store.
+    '''
+    if not os.path.exists(store_dir):
+        return []
+
+    months = [x.split('.')[0].replace('od-partials-', '') for x in os.listdir(store_dir)
+              if x.startswith('od-partials-') and x.endswith('.npz')]
+
+    return sorted(months)
+
+def save_month_partials(store_dir, month, station_sums, all_stations):
+    '''
+    Save the station sums of a single month to the OD store (the OD matrix is
+    saved as sparse triplets).
+    '''
+    month_data = {}
+    month_data['stations'] = np.array(all_stations, dtype=str)
+
+    for inst_key in station_sums:
+        if inst_key == 'od':
+            inst_coo = sparse.coo_matrix(station_sums['od'])
+            month_data['od-row'] = inst_coo.row
+            month_data['od-col'] = inst_coo.col
+            month_data['od-data'] = inst_coo.data
+        else:
+            month_data[inst_key] = station_sums[inst_key]
+
+    # write to a temporary file first so that a failed update does not
+    # leave a partial month in the store
+    filename = store_dir + '/od-partials-' + month + '.npz'
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as f:
+        np.savez_compressed(f, **month_data)
+    os.replace(tmp_filename, filename)
+
+def load_month_partials(store_dir, month):
+    '''
+    Load the station sums and stations of a single month from the OD store.
+    '''
+    filename = store_dir + '/od-partials-' + month + '.npz'
+
+    with np.load(filename, allow_pickle=False) as month_data:
+        all_stations = month_data['stations'].tolist()
+        num_stations = len(all_stations)
+
+        station_sums = {}
+        station_sums['od'] = sparse.coo_matrix((month_data['od-data'],
+                                                (month_data['od-row'], month_data['od-col'])),
+                                               shape=(num_stations, num_stations)).tocsc()
+        for inst_key in month_data.files:
+            if inst_key != 'stations' and not inst_key.startswith('od-'):
+                station_sums[inst_key] = month_data[inst_key]
+
+    return station_sums, all_stations
+
+def update_od_store(store_dir, month, trip_files, chunksize=500000, overwrite=False):
+    '''
+    Add the partial sums (OD counts, coordinate sums, birth year sums/counts,
+    and birth year histograms) of a single month to the OD store. Months that
+    are already in the store are skipped unless overwrite=True.
+    '''
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+
+    if month in get_od_store_months(store_dir) and not overwrite:
+        print('already stored', month)
+        return
+
+    station_sums, all_stations = stream_station_sums(trip_files, chunksize=chunksize,
+                                                     to_sparse=True)
+    save_month_partials(store_dir, month, station_sums, all_stations)
+
+    print('stored', month, len(all_stations), 'stations')
+
+def load_od_store(store_dir, start_month=None, end_month=None):
+    '''
+    Add up the partial sums of the months in the OD store between start_month
+    and end_month (inclusive). Returns the station sums and all stations
+    sorted by name.
+    '''
+    months = get_od_store_months(store_dir)
+    if start_month is not None:
+        months = [x for x in months if x >= start_month]
+    if end_month is not None:
+        months = [x for x in months if x <= end_month]
+
+    if len(months) == 0:
+        raise ValueError('no months in OD store ' + store_dir + ' for this range')
+
+    # stations of all months
+    list_stations = []
+    for inst_month in months:
+        with np.load(store_dir + '/od-partials-' + inst_month + '.npz', allow_pickle=False) as month_data:
+            list_stations.extend(month_data['stations'].tolist())
+    all_stations = sorted(set(list_stations))
+    ser_index = pd.Series(np.arange(len(all_stations)), index=all_stations)
+
+    station_sums = None
+    for inst_month in months:
+        month_sums, month_stations = load_month_partials(store_dir, inst_month)
+        month_sums = expand_station_sums(month_sums, ser_index[month_stations].values,
+                                         len(all_stations))
+        station_sums = add_station_sums(station_sums, month_sums)
+
+    return station_sums, all_stations
+
+def materialize_od_store(store_dir, start_month=None, end_month=None, inst_year=2020,
+                         mean_age=40, to_sparse=False):
+    '''
+    Make the origin-destination matrix and station metadata (see
+    make_od_matrix) for a range of months from the OD store without reading
+    any rides.
+    '''
+    station_sums, all_stations = load_od_store(store_dir, start_month=start_month,
+                                               end_month=end_month)
+    station_sums, all_stations = keep_departing_stations(station_sums, all_stations)
+
+    if not to_sparse:
+        station_sums['od'] = station_sums['od'].toarray()
+
+    df_dest, df_station = station_sums_to_df(station_sums, all_stations,
+                                             inst_year=inst_year, mean_age=mean_age)
+
+    return df_dest, df_station
+
+def split_cat_labels(labels):
+    '''
+    Split clustergrammer2 tuple labels (name, 'title: value', ...) into
+    names and a list of categories (dictionaries with title and values).
+    '''
+    names = [x[0] if isinstance(x, tuple) else x for x in labels]
+
+    list_cats = []
+    if len(labels) > 0 and isinstance(labels[0], tuple):
+        for inst_index in range(1, len(labels[0])):
+            inst_title = labels[0][inst_index].split(': ')[0]
+            inst_values = [x[inst_index].split(': ', 1)[-1] for x in labels]
+            list_cats.append({'title': inst_title, 'values': inst_values})
+
+    return names, list_cats
+
+def get_bundle_offset(header_length):
+    '''
+    Byte offset of the matrix in a viz bundle (64 byte aligned).
+    '''
+    offset = len(b'CG2BUNDL') + 8 + header_length
+    return offset + (-offset % 64)
+
+def save_viz_bundle(filename, df_export, df_meta, viz):
+    '''
+    Save the exported clustergrammer2 matrix (as raw float32), the plain row
+    and column names, their categories, the station metadata, and the
+    visualization JSON (net.viz) to a single binary file. The dashboard
+    memory maps the matrix with load_viz_bundle.
+    '''
+    rows, row_cats = split_cat_labels(df_export.index.tolist())
+    cols, col_cats = split_cat_labels(df_export.columns.tolist())
+
+    header = {}
+    header['shape'] = list(df_export.shape)
+    header['rows'] = rows
+    header['cols'] = cols
+    header['row_cats'] = row_cats
+    header['col_cats'] = col_cats
+    header['meta_index'] = df_meta.index.tolist()
+    header['meta_columns'] = df_meta.columns.tolist()
+    header['meta'] = [df_meta[x].tolist() for x in df_meta.columns]
+    header['viz'] = viz
+
+    header_bytes = json.dumps(header).encode('utf-8')
+    offset = get_bundle_offset(len(header_bytes))
+
+    with open(filename, 'wb') as f:
+        f.write(b'CG2BUNDL')
+        f.write(np.uint64(len(header_bytes)).tobytes())
+        f.write(header_bytes)
+        f.write(b'\0' * (offset - f.tell()))
+        np.ascontiguousarray(df_export.values, dtype=np.float32).tofile(f)
+
+def load_viz_bundle(filename):
+    '''
+    Load a viz bundle (see save_viz_bundle). The matrix DataFrame is backed by
+    a read-only memory map of the file and labels are plain station names.
+    Returns a dictionary with mat, row_cats, col_cats, meta, and viz.
+    '''
+    with open(filename, 'rb') as f:
+        if f.read(8) != b'CG2BUNDL':
+            raise ValueError(filename + ' is not a viz bundle')
+        header_length = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+        header = json.loads(f.read(header_length).decode('utf-8'))
+
+    mat = np.memmap(filename, dtype=np.float32, mode='r',
+                    offset=get_bundle_offset(header_length),
+                    shape=tuple(header['shape']))
+
+    bundle = {}
+    bundle['mat'] = pd.DataFrame(mat, index=header['rows'], columns=header['cols'], copy=False)
+
+    for inst_axis in ['row', 'col']:
+        df_cats = pd.DataFrame(index=header[inst_axis + 's'])
+        for inst_cat in header[inst_axis + '_cats']:
+            df_cats[inst_cat['title']] = pd.Categorical(inst_cat['values'])
+        bundle[inst_axis + '_cats'] = df_cats
+
+    bundle['meta'] = pd.DataFrame(dict(zip(header['meta_columns'], header['meta'])),
+                                  index=header['meta_index'], columns=header['meta_columns'])
+    bundle['viz'] = header['viz']
+
+    return bundle
+
+def get_umap_key(df, n_neighbors=20, min_dist=1.0, metric='correlation', random_state=99):
+    '''
+    Fingerprint of a matrix (values and labels) and the UMAP parameters that
+    is used to cache embeddings (see make_umap_embedding).
+    '''
+    inst_hash = hashlib.sha1()
+    inst_hash.update(np.ascontiguousarray(df.values, dtype=np.float64).tobytes())
+    inst_hash.update(json.dumps([str(x) for x in df.index.tolist()]).encode('utf-8'))
+    inst_hash.update(json.dumps([str(x) for x in df.columns.tolist()]).encode('utf-8'))
+    inst_hash.update(json.dumps([n_neighbors, min_dist, metric, random_state]).encode('utf-8'))
+
+    return inst_hash.hexdigest()
+
+def get_umap_features(df):
+    '''
+    Station names of the rows of df (first entry of clustergrammer tuple
+    labels), used to match the features of a UMAP fit across months since
+    the category values in the labels (e.g. arriving age) change every month.
+    '''
+    return [x[0] if isinstance(x, tuple) else x for x in df.index.tolist()]
+
+def make_umap_embedding(df, n_neighbors=20, min_dist=1.0, metric='correlation', random_state=99,
+                        cache_dir=None):
+    '''
+    Embed the columns of df with UMAP. If cache_dir is given embeddings (and
+    the fitted UMAP model) are saved using a fingerprint of the matrix and
+    parameters as key and are re-used if the same matrix is embedded again.
+    '''
+    if cache_dir is not None:
+        key = get_umap_key(df, n_neighbors=n_neighbors, min_dist=min_dist,
+                           metric=metric, random_state=random_state)
+        coords_file = cache_dir + '/umap-' + key + '.npy'
+        if os.path.exists(coords_file):
+            embedding = np.load(coords_file)
+            return pd.DataFrame(data=embedding, columns=['x', 'y'], index=df.columns)
+
+    import umap
+
+    umap_model = umap.UMAP(n_neighbors=n_neighbors, random_state=random_state,
+                           min_dist=min_dist, metric=metric)
+    embedding = umap_model.fit_transform(df.transpose())
+
+    if cache_dir is not None:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+        np.save(coords_file, embedding)
+
+        # save model (and features) to embed new data without refitting
+        with open(cache_dir + '/umap-' + key + '.pkl', 'wb') as f:
+            pickle.dump({'model': umap_model, 'features': get_umap_features(df)}, f)
+
+    return pd.DataFrame(data=embedding, columns=['x', 'y'], index=df.columns)
+
+def transform_umap_embedding(df_new, key, cache_dir, min_overlap=0.5):
+    '''
+    Embed the columns of a new matrix (e.g. a new month) using a cached UMAP
+    fit (key from get_umap_key) instead of refitting. Rows of the new matrix
+    are aligned to the features of the fit by station name (missing features
+    are zero); raises a ValueError if less than min_overlap of the features
+    of the fit are found in the new matrix.
+    '''
+    with open(cache_dir + '/umap-' + key + '.pkl', 'rb') as f:
+        umap_fit = pickle.load(f)
+
+    new_features = get_umap_features(df_new)
+    found_features = set(new_features).intersection(umap_fit['features'])
+    feature_overlap = len(found_features) / float(max(len(umap_fit['features']), 1))
+    print('UMAP feature overlap', round(feature_overlap, 3))
+    if feature_overlap < min_overlap:
+        raise ValueError('only ' + str(len(found_features)) + ' of ' + str(len(umap_fit['features'])) +
+                         ' features of the UMAP fit are in the new matrix')
+
+    df_aligned = pd.DataFrame(data=df_new.values, index=new_features, columns=df_new.columns)
+    df_aligned = df_aligned.reindex(index=umap_fit['features'], fill_value=0)
+    embedding = umap_fit['model'].transform(df_aligned.transpose())
+
+    return pd.DataFrame(data=embedding, columns=['x', 'y'], index=df_new.columns)
+
+def cluster_stations(trip_files, group_levels=[6], inst_year=2020, mean_age=40, clip=5,
+                     dist_type='cosine', chunksize=500000):
+    '''
+    Run the notebook clustering pipeline on one or more trip files: OD matrix,
+    station categories, umi_norm, z-score, clip, cluster, and dendro_cats.
+    The matrix is clustered once and dendro_cats is run for each group level.
+    Returns a list with the dendrogram cluster of each origin station
+    ('Group N') for each group level.
+    '''
+    from copy import deepcopy
+    from clustergrammer2 import net
+    import himc_helper_functions_v0_12_3 as hf
+    from make_df_from_cols import make_df_from_cols
+
+    od_data, df_station = stream_od_matrix(trip_files, inst_year=inst_year, mean_age=mean_age,
+                                           chunksize=chunksize, to_sparse=True)
+    all_stations = od_data['barcodes']
+
+    df_meta = parse_station_names(all_stations)
+    for inst_col in df_station.columns:
+        df_meta[inst_col] = df_station[inst_col]
+
+    add_cat_list = ['cross-x', 'cross-y', 'departing age']
+    od_data['barcodes'] = hf.add_cats_from_meta(add_cat_list=add_cat_list, barcodes=all_stations, df_meta=df_meta)
+
+    add_cat_list = ['cross-x', 'cross-y', 'arriving age']
+    od_data['features'] = hf.add_cats_from_meta(add_cat_list=add_cat_list, barcodes=all_stations, df_meta=df_meta)
+
+    df_norm = hf.convert_to_dense({'od': umi_norm_sparse(od_data)})['od']
+
+    net.load_df(df_norm)
+    net.normalize(axis='row', norm_type='zscore')
+    net.clip(-clip, clip)
+    net.cluster(dist_type=dist_type)
+
+    # dendro_cats reloads the network without its clustering, so each group
+    # level starts from a copy of the clustered network
+    clust_dat = deepcopy(net.dat)
+
+    list_ser = []
+    for group_level in group_levels:
+        net.dat = deepcopy(clust_dat)
+        net.dendro_cats(axis='col', dendro_level=group_level)
+
+        cols = net.export_df().columns.tolist()
+        list_ser.append(make_df_from_cols(cols)['Group ' + str(group_level)])
+
+    return list_ser
+
+def run_clustering_batch(trip_runs, group_levels=[6], max_workers=None, **cluster_args):
+    '''
+    Cluster stations for several runs (dictionary of run name -> trip
+    file(s), e.g. one run per month) and dendrogram group levels using a
+    process pool with one job per run (see cluster_stations for
+    cluster_args). Returns a station by run table of cluster assignments
+    (columns like '201907 Group 6').
+    '''
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+
+        futures = []
+        for inst_run in trip_runs:
+            inst_future = executor.submit(cluster_stations, trip_runs[inst_run],
+                                          group_levels=group_levels, **cluster_args)
+            futures.append((inst_run, inst_future))
+
+        list_ser = []
+        for inst_run, inst_future in futures:
+            for ser_cluster in inst_future.result():
+                ser_cluster.name = inst_run + ' ' + ser_cluster.name
+                list_ser.append(ser_cluster)
+
+    df_clusters = pd.concat(list_ser, axis=1, sort=True)
+
+    return df_clusters
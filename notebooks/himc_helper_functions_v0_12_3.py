@@ -2,13 +2,14 @@
 # This is a set of scripts that are used in processing 10x single cell data
 
 import gzip
-from scipy import io
-from scipy.sparse import csc_matrix
+from scipy.sparse import csc_matrix, csr_matrix
 from ast import literal_eval as make_tuple
 import pandas as pd
 import numpy as np
 from copy import deepcopy
 import os
+import json
+from concurrent.futures import ThreadPoolExecutor
 import matplotlib.pyplot as plt
 
 def get_version():
@@ -18,177 +19,302 @@ def make_dir(directory):
     if not os.path.exists(directory):
         os.mkdir(directory)
 
-def load_crv3_feature_matrix(inst_path, to_csc=True, hto_list=None,
-                             drop_default_lane=True, add_lane_to_barcodes=None):
+def get_source_signature(filenames):
+    '''
+    Size and modification time of source files, used to check whether a
+    binary cache is still valid
+    '''
+    signature = {}
+    for filename in filenames:
+        inst_stat = os.stat(filename)
+        signature[os.path.abspath(filename)] = [inst_stat.st_size, inst_stat.st_mtime]
+    return signature
 
+def save_feature_data_cache(feature_data, cache_dir, source_files, params=None):
+    '''
+    Save feature_data (sparse matrix arrays and label arrays) to a directory
+    of .npy files that can be memory-mapped on load. The manifest is written
+    last so that an interrupted save is never used.
+    '''
+    make_dir(cache_dir)
 
-    # Read Barcodes
-    ###########################
-    filename = inst_path + 'barcodes.tsv.gz'
-    f = gzip.open(filename, 'rt')
-    lines = f.readlines()
-    f.close()
+    manifest = {}
+    manifest['sources'] = get_source_signature(source_files)
+    manifest['params'] = params
+    manifest['feature_types'] = {}
 
-    # if we are adding a lane, then we always want to drop the default cr lane
-    if add_lane_to_barcodes is not None:
-        drop_default_lane = True
+    for inst_feat in feature_data:
+        inst_mat = feature_data[inst_feat]['mat']
+        inst_format = inst_mat.getformat()
 
-    barcodes = []
-    for inst_bc in lines:
-        inst_bc = inst_bc.strip().split('\t')
+        inst_arrays = {'data': inst_mat.data,
+                       'indices': inst_mat.indices,
+                       'indptr': inst_mat.indptr,
+                       'features': np.array(feature_data[inst_feat]['features'], dtype=str),
+                       'barcodes': np.array(feature_data[inst_feat]['barcodes'], dtype=str)}
 
-        # remove dash from barcodes if necessary
-        if drop_default_lane:
-            if '-' in inst_bc[0]:
-                inst_bc[0] = inst_bc[0].split('-')[0]
-            else:
-                print('did not find initial lane from cellranger')
+        for inst_name in inst_arrays:
+            np.save(os.path.join(cache_dir, inst_feat + '-' + inst_name + '.npy'),
+                    inst_arrays[inst_name])
 
-        barcodes.append(inst_bc[0])
+        manifest['feature_types'][inst_feat] = {'format': inst_format,
+                                                'shape': list(inst_mat.shape)}
 
-    if add_lane_to_barcodes is not None:
-        barcodes = [x + '-' + add_lane_to_barcodes for x in barcodes]
+    manifest_file = os.path.join(cache_dir, 'manifest.json')
+    with open(manifest_file + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(manifest_file + '.tmp', manifest_file)
 
-    # Load Matrix
-    #################
-    mat = io.mmread(inst_path + 'matrix.mtx.gz')
-    mat_csr = mat.tocsr()
+def load_feature_data_cache(cache_dir, source_files, params=None, mmap=True):
+    '''
+    Load feature_data saved with save_feature_data_cache, returns None if
+    there is no cache or the source files (size and mtime) or loader params
+    changed. Matrix arrays are memory-mapped copy-on-write by default.
+    '''
+    manifest_file = os.path.join(cache_dir, 'manifest.json')
+    if not os.path.exists(manifest_file):
+        return None
 
-    # Get Indexes of Feature Types
-    ##################################
-    filename = inst_path + 'features.tsv.gz'
-    f = gzip.open(filename, 'rt')
-    lines = f.readlines()
-    f.close()
-
-    feature_indexes = {}
-    feature_lines = {}
-    for index in range(len(lines)):
-
-        inst_line = lines[index].strip().split('\t')
-        inst_feat = inst_line[2].replace('Gene Expression', 'gex')#
-        if hto_list is None:
-            inst_feat = inst_feat.replace('Antibody Capture', 'adt').replace('Custom', 'custom')
-        else:
-            if inst_feat == 'Custom':
-                inst_feat = ('hto' if inst_line[0] in hto_list else 'adt')
+    with open(manifest_file, 'r') as f:
+        manifest = json.load(f)
 
-        if inst_feat not in feature_indexes:
-            feature_indexes[inst_feat] = []
+    if manifest['sources'] != get_source_signature(source_files) or manifest['params'] != params:
+        return None
 
-        feature_indexes[inst_feat].append(index)
+    mmap_mode = 'c' if mmap else None
 
     feature_data = {}
+    for inst_feat in manifest['feature_types']:
+        inst_info = manifest['feature_types'][inst_feat]
 
-    for inst_feat in feature_indexes:
-        feature_data[inst_feat] = {}
+        inst_arrays = {}
+        for inst_name in ['data', 'indices', 'indptr']:
+            inst_arrays[inst_name] = np.load(os.path.join(cache_dir, inst_feat + '-' + inst_name + '.npy'),
+                                             mmap_mode=mmap_mode)
 
-        feature_data[inst_feat]['barcodes'] = barcodes
+        mat_type = csc_matrix if inst_info['format'] == 'csc' else csr_matrix
 
-        inst_indexes = feature_indexes[inst_feat]
+        feature_data[inst_feat] = {}
+        feature_data[inst_feat]['mat'] = mat_type((inst_arrays['data'], inst_arrays['indices'],
+                                                   inst_arrays['indptr']),
+                                                  shape=tuple(inst_info['shape']), copy=False)
 
-        # Separate feature lists
-        ser_lines = pd.Series(lines)
-        ser_lines_found = ser_lines[inst_indexes]
-        lines_found = ser_lines_found.get_values().tolist()
+        for inst_name in ['features', 'barcodes']:
+            feature_data[inst_feat][inst_name] = np.load(os.path.join(cache_dir, inst_feat + '-' + inst_name + '.npy')).tolist()
 
-        # save feature lines
-        feature_lines[inst_feat] = lines_found
+    return feature_data
 
-        # save as compressed sparse column matrix (for barcode filtering)
-        mat_filt = (mat_csr[inst_indexes, :].tocsc() if to_csc else mat_csr[inst_indexes, :])
+def read_mtx_triplets(filename):
+    '''
+    Read a (gzipped) Matrix Market coordinate file and return its shape and
+    zero-based row, column, and value arrays. The triplets are parsed with
+    the multithreaded pyarrow csv reader if it is available.
+    '''
+    opener = gzip.open if filename.endswith('.gz') else open
 
-        feature_data[inst_feat]['mat'] = mat_filt
+    # header: banner, comments, and a size line (rows, cols, entries)
+    num_header = 0
+    with opener(filename, 'rt') as f:
+        for line in f:
+            num_header += 1
+            if num_header == 1:
+                banner = line.lower().split()
+            if not line.startswith('%'):
+                mat_size = [int(x) for x in line.split()]
+                break
 
-    # Make unique feature names
-    for inst_feat in feature_lines:
-        feat_lines = feature_lines[inst_feat]
-        feat_lines = [x.strip().split('\t') for x in feat_lines]
+    if 'coordinate' not in banner or 'pattern' in banner:
+        raise ValueError('only coordinate matrix market files with values are supported: ' + filename)
 
-        # find non-unique initial feature names (add id later if necessary)
-        ini_names = [x[1] for x in feat_lines]
+    value_dtype = np.float64 if 'real' in banner else np.int64
+    col_names = ['row', 'col', 'data']
 
-        ini_name_count = pd.Series(ini_names).value_counts()
-        duplicate_names = ini_name_count[ini_name_count > 1].index.tolist()
+    try:
+        import pyarrow as pa
+        from pyarrow import csv as pa_csv
 
-        new_names = [x[1] if x[1] not in duplicate_names else x[1] + '_' + x[0] for x in feat_lines]
+        read_options = pa_csv.ReadOptions(skip_rows=num_header, column_names=col_names, use_threads=True)
+        parse_options = pa_csv.ParseOptions(delimiter=' ')
+        convert_options = pa_csv.ConvertOptions(column_types={'row': pa.int32(), 'col': pa.int32(),
+                                                              'data': pa.from_numpy_dtype(value_dtype)})
 
-        # quick hack to clean up names
-        new_names = [x.replace('_TotalSeqB', '') for x in new_names]
+        table = pa_csv.read_csv(filename, read_options=read_options, parse_options=parse_options,
+                                convert_options=convert_options)
 
-        feature_data[inst_feat]['features'] = new_names
+        row, col, data = [table.column(x).to_numpy() for x in col_names]
 
+    except ImportError:
+        df_mtx = pd.read_csv(filename, sep=' ', header=None, names=col_names, skiprows=num_header,
+                             dtype={'row': np.int32, 'col': np.int32, 'data': value_dtype})
 
+        row, col, data = [df_mtx[x].values for x in col_names]
 
+    # matrix market is one-based
+    return mat_size[:2], row - 1, col - 1, data
 
-    return feature_data
+def read_tsv_labels(filename):
+    '''
+    Read a (gzipped) tab separated label file (e.g. barcodes or features)
+    as a DataFrame of strings
+    '''
+    return pd.read_csv(filename, sep='\t', header=None, dtype=str,
+                       keep_default_na=False, quoting=3)
 
-def load_crv2_gene_matrix(inst_path):
+def load_crv3_feature_matrix(inst_path, to_csc=True, hto_list=None,
+                             drop_default_lane=True, add_lane_to_barcodes=None,
+                             cache_dir=None, max_workers=3):
     '''
-    Loads gene expression data from 10x in sparse matrix format and returns a
-    Pandas dataframe
+    Load a cellranger v3 feature matrix (barcodes, features, and matrix) as
+    a feature_data dictionary with one sparse matrix per feature type. The
+    three files are decompressed and parsed in parallel threads and the
+    matrix triplets are converted straight to per feature type matrices.
+    Optionally, the decoded matrices are saved to (and reloaded from) a
+    binary cache in cache_dir.
     '''
 
-    import pandas as pd
-    from scipy import io
-    from scipy import sparse
-    from ast import literal_eval as make_tuple
+    source_files = [inst_path + x for x in ['barcodes.tsv.gz', 'features.tsv.gz', 'matrix.mtx.gz']]
 
-    # matrix
-    mat = io.mmread( inst_path + 'matrix.mtx').tocsc()
+    # hto_list is saved as a sorted list so that sets and tuples can be cached
+    # and compared with the (json) cache params
+    params = {'to_csc': to_csc, 'hto_list': sorted(hto_list) if hto_list is not None else None,
+              'drop_default_lane': drop_default_lane,
+              'add_lane_to_barcodes': add_lane_to_barcodes}
 
+    if cache_dir is not None:
+        feature_data = load_feature_data_cache(cache_dir, source_files, params=params)
+        if feature_data is not None:
+            return feature_data
 
-    # genes
-    filename = inst_path + 'genes.tsv'
-    f = open(filename, 'r')
-    lines_genes = f.readlines()
-    f.close()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        future_bc = executor.submit(read_tsv_labels, source_files[0])
+        future_feat = executor.submit(read_tsv_labels, source_files[1])
+        future_mtx = executor.submit(read_mtx_triplets, source_files[2])
 
-    # make unique gene names
-    #############################
-    gene_list = [x.strip().split('\t') for x in lines_genes]
+        df_bc = future_bc.result()
+        df_feat = future_feat.result()
+        mat_size, row, col, data = future_mtx.result()
 
-    # find non-unique initial gene names
-    ini_names = [x[1] for x in gene_list]
+    # Barcodes
+    ###########################
 
-    ini_name_count = pd.Series(ini_names).value_counts()
-    duplicate_names = ini_name_count[ini_name_count > 1].index.tolist()
-    genes = [x[1] if x[1] not in duplicate_names else x[1] + '_' + x[0] for x in gene_list]
+    # if we are adding a lane, then we always want to drop the default cr lane
+    if add_lane_to_barcodes is not None:
+        drop_default_lane = True
 
+    ser_bc = df_bc[0]
 
-    # barcodes
-    filename = inst_path + 'barcodes.tsv'
-    f = open(filename, 'r')
-    lines = f.readlines()
-    f.close()
+    # remove dash from barcodes if necessary
+    if drop_default_lane:
+        has_lane = ser_bc.str.contains('-', regex=False)
+        if not has_lane.all():
+            print('did not find initial lane from cellranger', (~has_lane).sum())
+        ser_bc = ser_bc.str.split('-', n=1).str[0]
 
-    cell_barcodes = []
-    for inst_bc in lines:
-        inst_bc = inst_bc.strip().split('\t')
+    if add_lane_to_barcodes is not None:
+        ser_bc = ser_bc + '-' + add_lane_to_barcodes
 
-        # remove dash from barcodes if necessary
-        if '-' in inst_bc[0]:
-          inst_bc[0] = inst_bc[0].split('-')[0]
+    barcodes = ser_bc.tolist()
 
-        cell_barcodes.append(inst_bc[0])
+    # Feature Types
+    ##################################
+    ser_feat = df_feat[2].str.replace('Gene Expression', 'gex', regex=False)
+    if hto_list is None:
+        ser_feat = ser_feat.str.replace('Antibody Capture', 'adt', regex=False)\
+                           .str.replace('Custom', 'custom', regex=False)
+    else:
+        is_custom = ser_feat == 'Custom'
+        is_hto = df_feat[0].isin(hto_list)
+        ser_feat[is_custom & is_hto] = 'hto'
+        ser_feat[is_custom & ~is_hto] = 'adt'
 
-    # parse tuples if necessary
-    try:
-        cell_barcodes = [make_tuple(x) for x in cell_barcodes]
-    except:
-        pass
+    # feature types in order of appearance, and the position of each feature
+    # within its feature type
+    feat_codes, feat_types = pd.factorize(ser_feat)
+    feat_positions = pd.Series(feat_codes).groupby(feat_codes).cumcount().values
 
-    try:
-        genes = [make_tuple(x) for x in genes]
-    except:
-        pass
+    row_codes = feat_codes[row]
+    mat_type = csc_matrix if to_csc else csr_matrix
 
-    # generate feature_data
     feature_data = {}
-    feature_data['gex'] = {}
-    feature_data['gex']['features'] = genes
-    feature_data['gex']['barcodes'] = cell_barcodes
-    feature_data['gex']['mat'] = mat
+    for inst_code, inst_feat in enumerate(feat_types):
+        feature_data[inst_feat] = {}
+        feature_data[inst_feat]['barcodes'] = barcodes
+
+        # Make unique feature names (add id if necessary)
+        df_inst = df_feat[feat_codes == inst_code]
+        ser_names = df_inst[1]
+        is_duplicate = ser_names.duplicated(keep=False)
+        ser_names = ser_names.where(~is_duplicate, ser_names + '_' + df_inst[0])
+
+        # quick hack to clean up names
+        feature_data[inst_feat]['features'] = ser_names.str.replace('_TotalSeqB', '', regex=False).tolist()
+
+        # build the matrix of this feature type from its triplets
+        keep = row_codes == inst_code
+        feature_data[inst_feat]['mat'] = mat_type((data[keep], (feat_positions[row[keep]], col[keep])),
+                                                  shape=(len(df_inst), mat_size[1]))
+
+    if cache_dir is not None:
+        save_feature_data_cache(feature_data, cache_dir, source_files, params=params)
+
+    return feature_data
+
+def parse_tuple_labels(labels, num_probe=5):
+    '''
+    Parse tuple labels, e.g. "('cell-1', 'type: T')", with literal_eval. Only
+    a few labels are probed first so that plain labels fail fast.
+    '''
+    try:
+        [make_tuple(x) for x in labels[:num_probe]]
+        return [make_tuple(x) for x in labels]
+    except Exception:
+        return labels
+
+def load_crv2_gene_matrix(inst_path, cache_dir=None):
+    '''
+    Loads gene expression data from 10x in sparse matrix format and returns a
+    feature_data dictionary. Optionally, the parsed matrix and labels are
+    saved to (and reloaded from) a binary cache in cache_dir.
+    '''
+
+    source_files = [inst_path + x for x in ['matrix.mtx', 'genes.tsv', 'barcodes.tsv']]
+
+    feature_data = None
+    if cache_dir is not None:
+        feature_data = load_feature_data_cache(cache_dir, source_files)
+
+    if feature_data is None:
+
+        # matrix
+        mat_size, row, col, data = read_mtx_triplets(source_files[0])
+        mat = csc_matrix((data, (row, col)), shape=mat_size)
+
+        # genes
+        df_genes = read_tsv_labels(source_files[1])
+
+        # make unique gene names
+        #############################
+        ser_genes = df_genes[1]
+        is_duplicate = ser_genes.duplicated(keep=False)
+        genes = ser_genes.where(~is_duplicate, ser_genes + '_' + df_genes[0]).tolist()
+
+        # barcodes (remove dash from barcodes if necessary)
+        df_bc = read_tsv_labels(source_files[2])
+        cell_barcodes = df_bc[0].str.split('-', n=1).str[0].tolist()
+
+        # generate feature_data
+        feature_data = {}
+        feature_data['gex'] = {}
+        feature_data['gex']['features'] = genes
+        feature_data['gex']['barcodes'] = cell_barcodes
+        feature_data['gex']['mat'] = mat
+
+        if cache_dir is not None:
+            save_feature_data_cache(feature_data, cache_dir, source_files)
+
+    # parse tuples if necessary
+    feature_data['gex']['barcodes'] = parse_tuple_labels(feature_data['gex']['barcodes'])
+    feature_data['gex']['features'] = parse_tuple_labels(feature_data['gex']['features'])
 
     return feature_data
 
@@ -327,17 +453,85 @@ def filter_barcodes_by_umi(feature_data, feature_type, min_umi=0, max_umi=1e8,
 
     return filtered_data
 
-def convert_to_dense(feat_data, df=None):
+def get_dense_subset(feat_data, inst_feat, features=None, barcodes=None):
+    '''
+    Row and column indexes (None for all) and labels of a feature type
+    subset, features is a dictionary of feature lists by feature type and
+    barcodes is a list of barcodes (used for all feature types)
+    '''
+    rows = feat_data[inst_feat]['features']
+    cols = feat_data[inst_feat]['barcodes']
+
+    rows_idx = None
+    if features is not None and inst_feat in features:
+        index_dict = dict((value, idx) for idx,value in enumerate(rows))
+        rows_idx = np.array([index_dict[x] for x in features[inst_feat]], dtype=np.int64)
+        rows = features[inst_feat]
+
+    cols_idx = None
+    if barcodes is not None:
+        index_dict = dict((value, idx) for idx,value in enumerate(cols))
+        cols_idx = np.array([index_dict[x] for x in barcodes], dtype=np.int64)
+        cols = barcodes
+
+    return rows_idx, cols_idx, list(rows), list(cols)
+
+def calc_dense_size(feat_data, dtype=None, features=None, barcodes=None):
+    '''
+    Size in bytes of the dense matrix of each feature type (see
+    convert_to_dense), nothing is allocated
+    '''
+    dense_size = {}
+    for inst_feat in feat_data:
+        mat = feat_data[inst_feat]['mat']
+        rows_idx, cols_idx, rows, cols = get_dense_subset(feat_data, inst_feat, features, barcodes)
+        inst_dtype = np.dtype(dtype) if dtype is not None else mat.dtype
+        dense_size[inst_feat] = len(rows) * len(cols) * inst_dtype.itemsize
+
+    return dense_size
+
+def convert_to_dense(feat_data, df=None, dtype=None, features=None, barcodes=None,
+                     output='dense', block_size=10000):
+    '''
+    Convert feature_data sparse matrices to DataFrames. dtype (e.g. float32,
+    int32, uint16) defaults to the matrix dtype, features (dictionary of
+    feature lists by feature type) and barcodes (list) are optional subsets.
+    With output='dense' a preallocated array is filled block_size columns at
+    a time, with output='sparse' the DataFrame uses pandas sparse arrays (use
+    calc_dense_size to check the size of dense output first).
+    '''
     # initialize df if necessary
     if df is None:
         df = {}
     for inst_feat in feat_data:
         mat = feat_data[inst_feat]['mat']
-        rows = feat_data[inst_feat]['features']
-        cols = feat_data[inst_feat]['barcodes']
+        if mat.getformat() != 'csc':
+            mat = mat.tocsc()
+
+        rows_idx, cols_idx, rows, cols = get_dense_subset(feat_data, inst_feat, features, barcodes)
+        inst_dtype = np.dtype(dtype) if dtype is not None else mat.dtype
+
+        if output == 'sparse':
+            if cols_idx is not None:
+                mat = mat[:, cols_idx]
+            if rows_idx is not None:
+                mat = mat[rows_idx, :]
+
+            df[inst_feat] = pd.DataFrame.sparse.from_spmatrix(mat.astype(inst_dtype), index=rows, columns=cols)
+
+        else:
+            dense_mat = np.empty((len(rows), len(cols)), dtype=inst_dtype)
 
-        dense_mat = mat.todense()
-        df[inst_feat] = pd.DataFrame(dense_mat, index=rows, columns=cols)
+            for start in range(0, len(cols), block_size):
+                stop = min(start + block_size, len(cols))
+
+                inst_block = mat[:, cols_idx[start:stop]] if cols_idx is not None else mat[:, start:stop]
+                if rows_idx is not None:
+                    inst_block = inst_block[rows_idx, :]
+
+                dense_mat[:, start:stop] = inst_block.toarray()
+
+            df[inst_feat] = pd.DataFrame(dense_mat, index=rows, columns=cols, copy=False)
 
     return df
 
@@ -348,45 +542,79 @@ def check_feature_data_size(feature_data):
             print(len(feature_data[inst_feat]['features']), len(feature_data[inst_feat]['barcodes']))
             print(feature_data[inst_feat]['mat'].shape, '\n')
 
-def get_mito_genes(gene_list):
-    # Removing Mitochondrial Genes
+def make_gene_annotation(gene_list):
+    '''
+    Annotate a gene list once and return boolean masks of gene classes:
+    'mito' and 'ribo' (case insensitive, used by get_mito_genes and
+    filter_ribo_mito_from_gex), 'mito-list' and 'ribo-list' (case sensitive,
+    ribo genes contain RPL/RPS, used by filter_ribo_mito_from_list), and
+    'other' (neither mito nor ribo).
+    '''
     ini_mito_list = ['MTRNR2L11', 'MTRF1', 'MTRNR2L12', 'MTRNR2L13', 'MTRF1L',
                      'MTRNR2L6', 'MTRNR2L7','MTRNR2L10', 'MTRNR2L8', 'MTRNR2L5',
                      'MTRNR2L1', 'MTRNR2L3', 'MTRNR2L4']
 
-    list_mito_genes = list(map(lambda x:x.lower(), ini_mito_list))
+    ser_genes = pd.Series(list(gene_list), dtype=object).astype(str)
+    ser_lower = ser_genes.str.lower()
+
+    gene_annotation = {}
+    gene_annotation['mito'] = ((ser_lower.str[:3] == 'mt-') |
+                               ser_lower.str.split('_', n=1).str[0].isin([x.lower() for x in ini_mito_list])).values
+    gene_annotation['ribo'] = (ser_lower.str.startswith('rpl') | ser_lower.str.startswith('rps')).values
+
+    gene_annotation['mito-list'] = ((ser_genes.str[:3] == 'MT-') |
+                                    ser_genes.str.split('_', n=1).str[0].isin(ini_mito_list)).values
+    gene_annotation['ribo-list'] = (ser_genes.str.contains('RPL', regex=False) |
+                                    ser_genes.str.contains('RPS', regex=False)).values
+
+    gene_annotation['other'] = ~(gene_annotation['mito'] | gene_annotation['ribo'])
+
+    return gene_annotation
 
-    found_mito_genes = [x for x in gene_list if 'mt-' == x[:3].lower() or
-                 x.split('_')[0].lower() in list_mito_genes]
+def get_mito_genes(gene_list, gene_annotation=None):
+    # Removing Mitochondrial Genes
+    if gene_annotation is None:
+        gene_annotation = make_gene_annotation(gene_list)
+
+    gene_list = list(gene_list)
+    found_mito_genes = [gene_list[x] for x in np.flatnonzero(gene_annotation['mito'])]
 
     return found_mito_genes
 
 def mito_prop_and_suspected_dead(df_gex, meta_cell, mito_thresh=0.9,
-                                 plot_mito=True, s=5, alpha=0.2):
+                                 plot_mito=True, s=5, alpha=0.2, gene_annotation=None):
+    '''
+    df_gex is a (genes x cells) DataFrame or a feature_data['gex'] dictionary
+    with a sparse matrix
+    '''
 
-    all_genes = df_gex.index.tolist()
-    mito_genes = get_mito_genes(all_genes)
+    is_sparse = isinstance(df_gex, dict)
+    all_genes = df_gex['features'] if is_sparse else df_gex.index.tolist()
 
+    if gene_annotation is None:
+        gene_annotation = make_gene_annotation(all_genes)
+    is_mito = gene_annotation['mito']
 
-    mito_sum = df_gex.loc[mito_genes].sum(axis=0)
+    if is_sparse:
+        cells = df_gex['barcodes']
+        qc = calc_sparse_qc_metrics(df_gex['mat'], metrics=['cell-sum'], keep_rows=is_mito)
+        mito_sum = pd.Series(qc['cell-sum'], index=cells)
+    else:
+        mito_sum = df_gex[is_mito].sum(axis=0)
 
     if 'gex-umi-sum' not in meta_cell.columns:
         print('calculating gex-umi-sum, not in meta_cell')
-        gex_sum = df_gex.sum(axis=0)
+        if is_sparse:
+            gex_sum = pd.Series(np.asarray(df_gex['mat'].sum(axis=0))[0], index=cells)
+        else:
+            gex_sum = df_gex.sum(axis=0)
     else:
         gex_sum = meta_cell['gex-umi-sum']
 
     mito_proportion = mito_sum/gex_sum
 
-    list_mito_dead = []
     cells = mito_proportion.index.tolist()
-    for inst_cell in cells:
-        inst_mito = mito_proportion[inst_cell]
-        if inst_mito >= mito_thresh:
-            inst_state = 'dead-cell'
-        else:
-            inst_state = 'live-cell'
-        list_mito_dead.append(inst_state)
+    list_mito_dead = np.where(mito_proportion.values >= mito_thresh, 'dead-cell', 'live-cell').tolist()
 
     ser_dead = pd.Series(list_mito_dead, index=cells)
 
@@ -396,8 +624,7 @@ def mito_prop_and_suspected_dead(df_gex, meta_cell, mito_thresh=0.9,
     if plot_mito:
         # mito_proportion.sort_values(ascending=False).plot()
 
-        all_cells = meta_cell.index.tolist()
-        color_list = ['red' if meta_cell.loc[x,'dead-cell-mito'] == 'dead-cell' else 'blue' for x in all_cells]
+        color_list = np.where(meta_cell['dead-cell-mito'].values == 'dead-cell', 'red', 'blue').tolist()
 
         meta_cell.plot(kind='scatter',
                        x='gex-umi-sum-ash',
@@ -454,15 +681,11 @@ def ini_meta_cell(df):
 
     df['meta_cell'] = pd.DataFrame(data=list_ser).transpose()
     if 'gex' in df.keys():
-        df_gex = deepcopy(df['gex'])
-        df_gex[df_gex >= 1] = 1
-        ser_gene_num = df_gex.sum(axis=0)
+        ser_gene_num = (df['gex'] >= 1).sum(axis=0)
         df['meta_cell']['num_expressed_genes'] = ser_gene_num
     return df
 
-def meta_cell_gex_wo_mito_ribo(df_gex_ini, meta_cell):
-
-    df_gex = deepcopy(df_gex_ini)
+def meta_cell_gex_wo_mito_ribo(df_gex, meta_cell):
 
     # calc umi sum
     ser_umi_sum = df_gex.sum(axis=0)
@@ -470,35 +693,188 @@ def meta_cell_gex_wo_mito_ribo(df_gex_ini, meta_cell):
     meta_cell['gex-umi-sum-no-ribo-mito'] = ser_umi_sum
 
     # count number of measured genes
-
-    df_gex[df_gex >= 1] = 1
-    ser_gene_num = df_gex.sum(axis=0)
+    ser_gene_num = (df_gex >= 1).sum(axis=0)
 
     meta_cell['num_expressed_genes_no-ribo-mito'] = ser_gene_num
 
     return meta_cell
 
-def ini_meta_gene(df_gex_ini):
-
-    df_gex = deepcopy(df_gex_ini)
+def ini_meta_gene(df_gex):
 
     # Mean UMI
     ser_gene_mean = df_gex.mean(axis=1)
     ser_gene_mean.name = 'mean'
 
     # Variance UMI
-    ser_gene_var = df_gex.mean(axis=1)
+    ser_gene_var = df_gex.var(axis=1)
     ser_gene_var.name = 'variance'
 
     # fraction of cells measured
-    df_gex[df_gex >= 1] = 1
-    ser_gene_meas = df_gex.sum(axis=1)/df_gex.shape[1]
+    ser_gene_meas = (df_gex >= 1).sum(axis=1)/df_gex.shape[1]
     ser_gene_meas.name = 'fraction of cells measured'
 
     meta_gene = pd.concat([ser_gene_mean, ser_gene_var, ser_gene_meas], axis=1)
 
     return meta_gene
 
+def sum_sparse_segments(mat, values=None, dtype=np.float64):
+    '''
+    Sum stored values (or per stored value values, e.g. a boolean mask) over
+    the major axis segments of a CSC (columns) or CSR (rows) matrix with
+    np.add.reduceat, empty segments are zero
+    '''
+    values = mat.data if values is None else values
+
+    seg_starts = mat.indptr[:-1]
+    is_nonempty = np.diff(mat.indptr) > 0
+
+    seg_sums = np.zeros(len(seg_starts), dtype=dtype)
+    if is_nonempty.any():
+        seg_sums[is_nonempty] = np.add.reduceat(values, seg_starts[is_nonempty], dtype=dtype)
+
+    return seg_sums
+
+def calc_sparse_qc_metrics(mat, metrics=None, keep_rows=None, thresh=1):
+    '''
+    QC metrics of a sparse (features x cells) CSC or CSR matrix without
+    densifying it: per-cell sums ('cell-sum') and number of values >= thresh
+    ('cell-num-expressed'), and per-feature sums ('feature-sum'), sums of
+    squares ('feature-sum-sq') and number of expressed cells
+    ('feature-num-expressed'). Only the requested metrics (default all) are
+    computed. keep_rows is an optional boolean mask of features to include
+    in the cell metrics.
+
+    Major axis metrics (cells for CSC) are reductions over indptr segments,
+    minor axis metrics are bincounts over indices, and masked cell sums are a
+    sparse matrix-vector product. Temporaries the size of the stored values
+    are only made for threshold/keep_rows masks (boolean) and
+    feature-sum-sq (squared values).
+    '''
+    if metrics is None:
+        metrics = ['cell-sum', 'cell-num-expressed', 'feature-sum', 'feature-sum-sq',
+                   'feature-num-expressed']
+
+    if mat.getformat() not in ['csc', 'csr']:
+        mat = mat.tocsc()
+
+    is_csc = mat.getformat() == 'csc'
+    num_rows, num_cols = mat.shape
+    data = mat.data
+
+    # boolean mask of expressed values (None if all stored values are expressed)
+    is_expressed = None
+    if any('num-expressed' in x for x in metrics):
+        if len(data) > 0 and data.min() < thresh:
+            is_expressed = data >= thresh
+
+    if keep_rows is not None:
+        keep_rows = np.asarray(keep_rows, dtype=bool)
+
+    qc = {}
+
+    if 'cell-sum' in metrics:
+        if keep_rows is not None:
+            qc['cell-sum'] = np.asarray(mat.transpose().dot(keep_rows.astype(data.dtype)), dtype=np.float64)
+        elif is_csc:
+            qc['cell-sum'] = sum_sparse_segments(mat)
+        else:
+            qc['cell-sum'] = np.bincount(mat.indices, weights=data, minlength=num_cols)
+
+    if 'cell-num-expressed' in metrics:
+        is_counted = is_expressed
+        if keep_rows is not None:
+            if is_csc:
+                is_kept = keep_rows[mat.indices]
+            else:
+                is_kept = np.repeat(keep_rows, np.diff(mat.indptr))
+            is_counted = is_kept if is_counted is None else is_counted & is_kept
+
+        if is_csc:
+            qc['cell-num-expressed'] = np.diff(mat.indptr) if is_counted is None else \
+                                       sum_sparse_segments(mat, is_counted, dtype=np.int64)
+        else:
+            qc['cell-num-expressed'] = np.bincount(mat.indices if is_counted is None else mat.indices[is_counted],
+                                                   minlength=num_cols)
+
+    if 'feature-sum' in metrics:
+        qc['feature-sum'] = np.bincount(mat.indices, weights=data, minlength=num_rows) if is_csc else \
+                            sum_sparse_segments(mat)
+
+    if 'feature-sum-sq' in metrics:
+        data_sq = np.square(data, dtype=np.float64)
+        qc['feature-sum-sq'] = np.bincount(mat.indices, weights=data_sq, minlength=num_rows) if is_csc else \
+                               sum_sparse_segments(mat, data_sq)
+
+    if 'feature-num-expressed' in metrics:
+        if is_csc:
+            qc['feature-num-expressed'] = np.bincount(mat.indices if is_expressed is None else mat.indices[is_expressed],
+                                                      minlength=num_rows)
+        else:
+            qc['feature-num-expressed'] = np.diff(mat.indptr) if is_expressed is None else \
+                                          sum_sparse_segments(mat, is_expressed, dtype=np.int64)
+
+    return qc
+
+def ini_meta_cell_sparse(feature_data):
+    '''
+    Sparse version of ini_meta_cell, returns meta_cell with the UMI sum of
+    each feature type and the number of expressed genes
+    '''
+    meta_cell = pd.DataFrame(index=feature_data[list(feature_data.keys())[0]]['barcodes'])
+
+    # look for available data types
+    found_types = list(set(['gex', 'adt', 'hto']).intersection(feature_data.keys()))
+    for inst_type in found_types:
+        inst_metrics = ['cell-sum', 'cell-num-expressed'] if inst_type == 'gex' else ['cell-sum']
+        qc = calc_sparse_qc_metrics(feature_data[inst_type]['mat'], metrics=inst_metrics)
+        meta_cell[inst_type + '-umi-sum'] = qc['cell-sum']
+
+        if inst_type == 'gex':
+            meta_cell['num_expressed_genes'] = qc['cell-num-expressed']
+
+    return meta_cell
+
+def meta_cell_gex_wo_mito_ribo_sparse(feature_data, meta_cell, keep_genes=None, gene_annotation=None):
+    '''
+    Sparse version of meta_cell_gex_wo_mito_ribo, UMI sums and number of
+    expressed genes excluding mito and ribo genes (the same genes as
+    filter_ribo_mito_from_gex) or only including keep_genes
+    '''
+    genes = feature_data['gex']['features']
+    if keep_genes is not None:
+        keep_rows = pd.Index(genes).isin(keep_genes)
+    else:
+        if gene_annotation is None:
+            gene_annotation = make_gene_annotation(genes)
+        keep_rows = ~(gene_annotation['mito'] | gene_annotation['ribo'])
+
+    qc = calc_sparse_qc_metrics(feature_data['gex']['mat'], metrics=['cell-sum', 'cell-num-expressed'],
+                                keep_rows=keep_rows)
+
+    meta_cell['gex-umi-sum-no-ribo-mito'] = qc['cell-sum']
+    meta_cell['num_expressed_genes_no-ribo-mito'] = qc['cell-num-expressed']
+
+    return meta_cell
+
+def ini_meta_gene_sparse(feature_data, feature_type='gex'):
+    '''
+    Sparse version of ini_meta_gene, returns the mean, variance, and fraction
+    of cells measured of each gene
+    '''
+    mat = feature_data[feature_type]['mat']
+    num_cells = mat.shape[1]
+
+    qc = calc_sparse_qc_metrics(mat, metrics=['feature-sum', 'feature-sum-sq', 'feature-num-expressed'])
+
+    ser_gene_mean = qc['feature-sum'] / num_cells
+    ser_gene_var = (qc['feature-sum-sq'] - num_cells * ser_gene_mean ** 2) / (num_cells - 1)
+
+    meta_gene = pd.DataFrame(index=feature_data[feature_type]['features'])
+    meta_gene['mean'] = ser_gene_mean
+    meta_gene['variance'] = np.clip(ser_gene_var, 0, None)
+    meta_gene['fraction of cells measured'] = qc['feature-num-expressed'] / num_cells
+
+    return meta_gene
 
 
 def plot_signal_vs_noise(df, alpha=0.25, s=10, hto_range=7, inf_replace=1000):
@@ -535,44 +911,34 @@ def plot_signal_vs_noise(df, alpha=0.25, s=10, hto_range=7, inf_replace=1000):
 
     return df_comp, sn_ratio
 
-def filter_ribo_mito_from_gex(df):
+def filter_ribo_mito_from_gex(df, gene_annotation=None):
 
     # save avg values to meta_cell
     if 'gex-mito-avg' not in df['meta_cell']:
 
-        df_gex = deepcopy(df['gex'])
-        meta_cell = deepcopy(df['meta_cell'])
-
-        all_genes = df_gex.index.tolist()
-
-        ini_genes = deepcopy(all_genes)
-
-        ribo_rpl = [x for x in all_genes if x.lower().startswith('rpl')]
-        ribo_rps = [x for x in all_genes if x.lower().startswith('rps')]
-        ribo_genes = ribo_rpl + ribo_rps
-
-        # calculate average ribo gene expression
-        ser_ribo = df_gex.loc[ribo_genes].mean(axis=0)
-
-        keep_genes = [x for x in all_genes if x not in ribo_genes]
-
-        df_gex = df_gex.loc[keep_genes]
+        df_gex = df['gex']
+        meta_cell = df['meta_cell'].copy()
 
         all_genes = df_gex.index.tolist()
 
-        mito_genes = get_mito_genes(all_genes)
+        if gene_annotation is None:
+            gene_annotation = make_gene_annotation(all_genes)
 
-        # calculate average mito gene expression
-        ser_mito = df_gex.loc[mito_genes].mean(axis=0)
+        # ribo genes, and mito genes (that are not ribo genes)
+        is_ribo = gene_annotation['ribo']
+        is_mito = gene_annotation['mito'] & ~is_ribo
 
-        keep_genes = [x for x in all_genes if x not in mito_genes]
+        # calculate average ribo and mito gene expression
+        ser_ribo = df_gex[is_ribo].mean(axis=0)
+        ser_mito = df_gex[is_mito].mean(axis=0)
 
         # save mito and ribo genes
-        mr_genes = sorted(list(set(ini_genes).difference(keep_genes)))
-        df_mr = df['gex'].loc[mr_genes]
+        is_keep = ~(is_ribo | is_mito)
+        mr_genes = sorted(set(all_genes).difference(df_gex.index[is_keep]))
+        df_mr = df_gex.loc[mr_genes]
 
         # drop mito and ribo genes
-        df_gex = df['gex'].loc[keep_genes]
+        df_gex = df_gex[is_keep]
 
         meta_cell['gex-ribo-avg'] = ser_ribo
         meta_cell['gex-mito-avg'] = ser_mito
@@ -585,29 +951,110 @@ def filter_ribo_mito_from_gex(df):
 
     return df
 
+def filter_ribo_mito_from_feature_data(feature_data, meta_cell, gene_annotation=None):
+    '''
+    Sparse version of filter_ribo_mito_from_gex, average ribo and mito gene
+    expression are saved to meta_cell, and gex is split into gex (without
+    mito and ribo genes) and gex-mr
+    '''
+    if 'gex-mito-avg' in meta_cell:
+        print('already filtered mito and ribo genes')
+        return feature_data, meta_cell
+
+    all_genes = feature_data['gex']['features']
+    mat = feature_data['gex']['mat']
+
+    if gene_annotation is None:
+        gene_annotation = make_gene_annotation(all_genes)
+
+    is_ribo = gene_annotation['ribo']
+    is_mito = gene_annotation['mito'] & ~is_ribo
+
+    # calculate average ribo and mito gene expression
+    meta_cell = meta_cell.copy()
+    for inst_name, inst_mask in [('gex-ribo-avg', is_ribo), ('gex-mito-avg', is_mito)]:
+        qc = calc_sparse_qc_metrics(mat, metrics=['cell-sum'], keep_rows=inst_mask)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            inst_avg = qc['cell-sum'] / inst_mask.sum()
+        meta_cell[inst_name] = pd.Series(inst_avg, index=feature_data['gex']['barcodes'])
 
-def add_cats_from_meta(barcodes, df_meta, add_cat_list):
+    # split mito and ribo genes from gex
+    is_keep = ~(is_ribo | is_mito)
+    all_genes = np.asarray(all_genes, dtype=object)
+    mr_genes = sorted(set(all_genes.tolist()).difference(all_genes[is_keep].tolist()))
+
+    feature_data = dict(feature_data)
+    feature_data['gex-mr'] = filter_sparse_matrix_by_list(feature_data, feature_type='gex', keep_rows=mr_genes)['gex']
+    feature_data['gex'] = filter_sparse_matrix_by_list(feature_data, feature_type='gex',
+                                                       keep_rows=all_genes[is_keep].tolist())['gex']
+
+    return feature_data, meta_cell
+
+def add_cats_from_meta(barcodes, df_meta, add_cat_list, output='tuples'):
     '''
     Add categories from df_meta.
+
+    Titled categories ('title: value') are made column-wise and each unique
+    value of a category is only formatted once. Use output='tuples' for a list
+    of tuple labels, output='lazy' for an iterator of tuple labels, or
+    output='array' for a structured array with one field per category.
     '''
 
     # get metadata of interest (add_cat_list) from barcodes of interest
-    df_cats = df_meta.loc[barcodes][add_cat_list]
+    df_cats = df_meta.loc[barcodes, add_cat_list]
+
+    # format each unique category value once
+    list_cols = []
+    for inst_cat in add_cat_list:
+        cat_codes, cat_values = pd.factorize(df_cats[inst_cat])
 
-    # get list of cats
-    list_cat_ini = [list(x) for x in df_cats.values]
+        # missing values have code -1 (last element)
+        cat_titles = np.array([str(inst_cat) + ': ' + str(x) for x in cat_values] +
+                              [str(inst_cat) + ': nan'], dtype=object)
 
-    # add titles to cats
-    list_cat_titles = [ list([str(x) + ': ' + str(y) for x,y in zip(add_cat_list, a)]) for a in list_cat_ini]
+        list_cols.append(cat_titles[cat_codes])
+
+    if output == 'array':
+        new_cols = np.empty(len(barcodes), dtype=[('barcode', object)] +
+                                                 [(str(x), object) for x in add_cat_list])
+        new_cols['barcode'] = barcodes
+        for inst_cat, inst_col in zip(add_cat_list, list_cols):
+            new_cols[str(inst_cat)] = inst_col
+        return new_cols
 
     # add barcodes to new columns
-    new_cols = [tuple([x] + y) for x,y in zip(barcodes, list_cat_titles)]
+    new_cols = zip(barcodes, *list_cols)
+
+    if output == 'tuples':
+        new_cols = list(new_cols)
 
     return new_cols
 
 
-def make_cyto_export(df, num_var_genes=500, inf_replace=10):
+def calc_noise_chunk(num_rows, num_cols, seed=99, chunk_index=0):
+    '''
+    Uniform float32 noise centered about zero and rounded to two decimals.
+    Each chunk has its own seed so that chunked exports are reproducible.
+    '''
+    rng = np.random.default_rng([seed, chunk_index])
+    return np.round(rng.random((num_rows, num_cols), dtype=np.float32) - 0.5, 2)
+
+def get_cyto_meta_names(meta_cols):
+    '''
+    Cytobank names of derived (metadata) columns, e.g. gex-umi-sum becomes
+    GEX_der_umi_sum
+    '''
+    return [x.split('-')[0].upper() + '_der_' +
+            '_'.join(x.split('-')[1:]).replace('num_unique', 'unique_gene_count')
+            for x in meta_cols]
 
+def prepare_cyto_export(df, num_var_genes=500):
+    '''
+    Set up a Cytobank export (cells x features) without building it. df has
+    gex/adt/hto as (features x cells) DataFrames or feature_data dictionaries
+    with sparse matrices, and a meta_cell DataFrame. The top variance genes
+    are selected here (sparse statistics for sparse matrices).
+    '''
     keep_meta_base = ['gex-umi-sum',
                       'gex-num-unique',
                       'gex-mito-proportion-umi',
@@ -618,61 +1065,191 @@ def make_cyto_export(df, num_var_genes=500, inf_replace=10):
                       'adt-umi-sum'
                       ]
 
-    df_cyto = None
+    # collect data blocks (features x cells) and their column names
+    list_blocks = []
+    cells = None
+    for inst_type in ['gex', 'adt', 'hto']:
+        if inst_type not in df.keys():
+            continue
+
+        inst_data = df[inst_type]
+        is_sparse = isinstance(inst_data, dict)
+
+        features = inst_data['features'] if is_sparse else inst_data.index.tolist()
+        inst_cells = inst_data['barcodes'] if is_sparse else inst_data.columns.tolist()
+
+        if cells is None:
+            cells = list(inst_cells)
+        elif not is_sparse and list(inst_cells) != cells:
+            inst_data = inst_data.reindex(columns=cells)
+
+        if is_sparse:
+            inst_mat = inst_data['mat']
+            if inst_mat.getformat() != 'csc':
+                inst_mat = inst_mat.tocsc()
+
+            # align sparse columns to the cells of the first data type
+            if list(inst_cells) != cells:
+                cell_index = dict((inst_cell, inst_index) for inst_index, inst_cell in enumerate(inst_cells))
+                missing_cells = [x for x in cells if x not in cell_index]
+                if len(missing_cells) > 0:
+                    raise ValueError(inst_type + ' is missing ' + str(len(missing_cells)) +
+                                     ' barcodes found in the other data types')
+                inst_mat = inst_mat[:, [cell_index[x] for x in cells]]
+        else:
+            inst_mat = inst_data.values
+
+        # filter for top var genes
+        if inst_type == 'gex':
+            if is_sparse:
+                num_cells = inst_mat.shape[1]
+                qc = calc_sparse_qc_metrics(inst_mat, metrics=['feature-sum', 'feature-sum-sq'])
+                ser_var = (qc['feature-sum-sq'] - qc['feature-sum'] ** 2 / num_cells) / (num_cells - 1)
+                keep_index = np.argsort(-ser_var, kind='stable')[:num_var_genes]
+            else:
+                ser_var = pd.Series(inst_data.var(axis=1).values)
+                keep_index = ser_var.sort_values(ascending=False).index.values[:num_var_genes]
+
+            inst_mat = inst_mat[keep_index]
+            features = [features[x] for x in keep_index]
 
-    for inst_type in ['gex', 'adt', 'hto', 'meta_cell']:
-        if inst_type in df.keys():
-            inst_df = deepcopy(df[inst_type])
+        list_blocks.append((inst_mat, is_sparse, [inst_type.upper() + '_' + x for x in features]))
 
-            # filter for top var genes
-            if inst_type == 'gex':
-                keep_var_genes = inst_df.var(axis=1).sort_values(ascending=False).index.tolist()[:num_var_genes]
+        print(inst_type, (len(features), len(cells)))
 
-                inst_df = inst_df.loc[keep_var_genes]
+    meta_cell = df['meta_cell']
+    if cells is None:
+        cells = meta_cell.index.tolist()
 
-            if 'meta' not in inst_type:
-                inst_df.index = [inst_type.upper() + '_' + x for x in inst_df.index.tolist()]
+    keep_meta = [metadata for metadata in keep_meta_base if metadata in meta_cell.columns]
+    meta_values = meta_cell[keep_meta].reindex(cells).values.astype(np.float32)
+    print('meta_cell', (len(keep_meta), len(cells)))
 
-            else:
-                keep_meta = [metadata for metadata in keep_meta_base if metadata in inst_df.columns]
-                inst_df = inst_df[keep_meta].transpose()
-                inst_df.index = [ x.split('-')[0].upper() + '_der_' +
-                                 '_'.join( x.split('-')[1:]).replace('num_unique', 'unique_gene_count')
-                                 for x in inst_df.index.tolist()]
+    export_info = {}
+    export_info['cells'] = cells
+    export_info['blocks'] = list_blocks
+    export_info['meta_values'] = meta_values
+    export_info['columns'] = [y for x in list_blocks for y in x[2]] + get_cyto_meta_names(keep_meta)
 
-            print(inst_type, inst_df.shape)
+    return export_info
 
-            if df_cyto is None:
-                df_cyto = inst_df
-            else:
-                df_cyto = df_cyto.append(inst_df)
+def iter_cyto_export(export_info, inf_replace=10, chunk_size=10000, seed=99):
+    '''
+    Generate a Cytobank export (see prepare_cyto_export) in chunks of cells,
+    data columns get seeded float32 noise per chunk. Yields DataFrames
+    indexed by the Cytobank-Index.
+    '''
+    cells = export_info['cells']
+    meta_values = export_info['meta_values']
 
-    df_export = df_cyto.transpose()
+    for chunk_index, start in enumerate(range(0, len(cells), chunk_size)):
+        stop = min(start + chunk_size, len(cells))
 
-    cells = df_export.index.tolist()
-    index_cells = [str(x/100) for x in range(len(cells))]
-    df_export.index = index_cells
+        list_arr = []
+        for inst_mat, is_sparse, _ in export_info['blocks']:
+            inst_arr = inst_mat[:, start:stop].toarray() if is_sparse else inst_mat[:, start:stop]
+            list_arr.append(inst_arr.transpose().astype(np.float32))
 
-    # Add noise
-    data_columns = [x for x in df_export.columns if '_der_' not in x]
+        arr_data = np.hstack(list_arr) if len(list_arr) > 0 else np.empty((stop - start, 0), dtype=np.float32)
 
-    not_derived_dataframe_shape = df_export[data_columns].shape
+        # center the noise about zero
+        arr_data += calc_noise_chunk(stop - start, arr_data.shape[1], seed=seed, chunk_index=chunk_index)
 
-    # center the noise about zero
-    rand_mat = np.random.rand(not_derived_dataframe_shape[0], not_derived_dataframe_shape[1]) - 0.5
+        arr_chunk = np.hstack([arr_data, meta_values[start:stop]])
 
-    df_noise = pd.DataFrame(data=rand_mat, index=index_cells, columns=data_columns).round(2)
-    df_export[data_columns] += df_noise
+        # replace inf and nans
+        arr_chunk[arr_chunk == np.inf] = inf_replace
+        arr_chunk[np.isnan(arr_chunk)] = 0
 
-    ser_index = pd.Series(data=index_cells, index=cells)
-    df['meta_cell']['Cytobank-Index'] = ser_index
+        index_cells = [str(x/100) for x in range(start, stop)]
+        df_chunk = pd.DataFrame(data=arr_chunk, index=index_cells, columns=export_info['columns'])
+        df_chunk.index.name = 'cell_index'
+
+        yield df_chunk
+
+def write_fcs_header(f, columns, num_events, par_range=262144):
+    '''
+    Write the header and TEXT segment of an FCS 3.0 file with float32 data
+    (the data segment follows directly)
+    '''
+    num_params = len(columns)
+    data_size = num_events * num_params * 4
+
+    def escape(x):
+        return str(x).replace('/', '//')
+
+    keywords = [('$BYTEORD', '1,2,3,4'), ('$DATATYPE', 'F'), ('$MODE', 'L'),
+                ('$NEXTDATA', '0'), ('$PAR', str(num_params)), ('$TOT', str(num_events)),
+                ('$BEGINANALYSIS', '0'), ('$ENDANALYSIS', '0'), ('$BEGINSTEXT', '0'), ('$ENDSTEXT', '0')]
+    for inst_index, inst_col in enumerate(columns):
+        inst_par = '$P' + str(inst_index + 1)
+        keywords.extend([(inst_par + 'N', inst_col), (inst_par + 'B', '32'),
+                         (inst_par + 'E', '0,0'), (inst_par + 'R', str(par_range))])
+
+    # data offsets are zero padded so that the TEXT length does not depend on them
+    text_start = 58
+    text_base = ''.join('/' + escape(x) + '/' + escape(y) for x, y in keywords)
+    text_length = len(('/$BEGINDATA/' + '0' * 20 + '/$ENDDATA/' + '0' * 20 + text_base + '/').encode('utf-8'))
+
+    data_start = text_start + text_length
+    data_end = data_start + data_size - 1
+    text = ('/$BEGINDATA/' + str(data_start).zfill(20) + '/$ENDDATA/' + str(data_end).zfill(20) +
+            text_base + '/').encode('utf-8')
+
+    # header offsets are limited to 8 digits (use TEXT offsets if larger)
+    header_data = [data_start, data_end] if data_end <= 99999999 else [0, 0]
+    header = 'FCS3.0    ' + ''.join(str(x).rjust(8) for x in [text_start, data_start - 1] + header_data + [0, 0])
+
+    f.write(header.encode('ascii'))
+    f.write(text)
+
+def write_cyto_export(df, filename, num_var_genes=500, inf_replace=10, chunk_size=10000, seed=99):
+    '''
+    Stream the Cytobank export (see prepare_cyto_export) to a CSV or FCS file
+    (if filename ends with .fcs) one chunk of cells at a time, and add the
+    Cytobank-Index to meta_cell. The FCS export has cell_index as its first
+    parameter.
+    '''
+    is_fcs = filename.lower().endswith('.fcs')
 
-    df_export.index.name = 'cell_index'
+    export_info = prepare_cyto_export(df, num_var_genes=num_var_genes)
+    cells = export_info['cells']
 
-    # replace inf and nans
-    df_export[df_export == np.inf] = inf_replace
-    df_export.fillna(0, inplace=True)
+    with open(filename, 'wb' if is_fcs else 'w') as f:
+        if is_fcs:
+            write_fcs_header(f, ['cell_index'] + export_info['columns'], len(cells))
 
+        start = 0
+        for df_chunk in iter_cyto_export(export_info, inf_replace=inf_replace, chunk_size=chunk_size, seed=seed):
+            if is_fcs:
+                arr_index = np.arange(start, start + df_chunk.shape[0])[:, None] / 100
+                np.hstack([arr_index, df_chunk.values]).astype('<f4').tofile(f)
+            else:
+                df_chunk.to_csv(f, header=(start == 0))
+
+            start = start + df_chunk.shape[0]
+
+        if is_fcs:
+            # no CRC
+            f.write(b'00000000')
+
+    index_cells = [str(x/100) for x in range(len(cells))]
+    df['meta_cell']['Cytobank-Index'] = pd.Series(data=index_cells, index=cells)
+
+    return df
+
+def make_cyto_export(df, num_var_genes=500, inf_replace=10, chunk_size=10000, seed=99):
+    '''
+    Make the Cytobank export (cells x features) as df['cyto-export'], see
+    write_cyto_export to stream large exports to disk instead
+    '''
+    export_info = prepare_cyto_export(df, num_var_genes=num_var_genes)
+
+    df_export = pd.concat(iter_cyto_export(export_info, inf_replace=inf_replace,
+                                           chunk_size=chunk_size, seed=seed), axis=0)
+
+    ser_index = pd.Series(data=df_export.index.tolist(), index=export_info['cells'])
+    df['meta_cell']['Cytobank-Index'] = ser_index
 
     df['cyto-export'] = df_export
 
@@ -713,17 +1290,27 @@ def concat_contig(ser_row):
 
     return inst_contig
 
+def make_contig_keys(inst_df):
+    '''
+    Vectorized version of concat_contig, define contigs as the merge of v, d,
+    j, and cdr3 genes for all rows of inst_df
+    '''
+    list_ser = []
+    for inst_col in ['v_gene', 'd_gene', 'j_gene', 'cdr3']:
+        ser_col = inst_df[inst_col].astype(object)
+        list_ser.append(ser_col.where(ser_col.notnull(), 'nan').astype(str))
+
+    # do not include c gene in clonotype definition (do not include c_gene)
+    ser_contig = list_ser[0] + '_' + list_ser[1] + '_' + list_ser[2] + '_' + list_ser[3]
+
+    return ser_contig
+
 def get_unique_contigs(inst_df):
     '''
     Define contigs as the merge of v, d, j, and cdr3 genes
     Then, find all unique contigs.
     '''
-    all_contigs = []
-    for inst_index in inst_df.index.tolist():
-        ser_row = inst_df.loc[inst_index]
-        inst_contig = concat_contig(ser_row)
-        all_contigs.append(inst_contig)
-    unique_contigs = sorted(list(set(all_contigs)))
+    unique_contigs = sorted(make_contig_keys(inst_df).unique().tolist())
     return unique_contigs
 
 def assign_ids_to_contigs(unique_contigs):
@@ -743,29 +1330,31 @@ def assign_ids_to_contigs(unique_contigs):
 
 def get_bc_contig_combos(inst_df, contig_id_dict):
     '''
-    Loop through the merged (across samples) filtered contigs
-    which has one row per contig
-
-    Define the contig (concat vdj genes) and find its unique id
-    using contig_id_dict
+    Define the contig (concat vdj genes) of each row of the merged (across
+    samples) filtered contigs and find its unique id using contig_id_dict
 
     Assemble list of contigs associated with each barcode (dict
     with barcode keys)
     '''
-    bc_contig_combos = {}
-    for inst_row in inst_df.index.tolist():
-        ser_row = inst_df.loc[inst_row]
-        inst_bc = ser_row['barcode']
-        inst_contig = concat_contig(ser_row)
-        inst_id = contig_id_dict[inst_contig]
-
-        if inst_bc not in bc_contig_combos:
-            bc_contig_combos[inst_bc] = []
+    ser_ids = make_contig_keys(inst_df).map(contig_id_dict)
+    ser_ids.index = range(len(ser_ids))
 
-        bc_contig_combos[inst_bc].append(inst_id)
+    bc_contig_combos = ser_ids.groupby(inst_df['barcode'].values, sort=False).agg(list).to_dict()
 
     return bc_contig_combos
 
+def rank_contig_combos(ser_combos):
+    '''
+    Number contig combos (clones) based on abundance, returns the new clone
+    name of each combo in ser_combos
+    '''
+    ser_counts = ser_combos.value_counts()
+
+    clone_names = ['custom-clone-' + str(x) for x in range(1, len(ser_counts) + 1)]
+    ser_clone = pd.Series(clone_names, index=ser_counts.index.tolist())
+
+    return ser_clone.reindex(ser_combos.values).tolist()
+
 def generate_new_clonotypes(bc_contig_combos):
     '''
     Define contig combinations as a new set of clones
@@ -774,46 +1363,60 @@ def generate_new_clonotypes(bc_contig_combos):
     Look up contig combo for each barcode (e.g. clone)
     Look up new clone name for contig comb
     '''
+    barcodes = list(bc_contig_combos.keys())
+    ser_combos = pd.Series(['_'.join(sorted(bc_contig_combos[x])) for x in barcodes])
 
-    # find most abundant contig combos (clones)
-    contig_id_combos = []
-    for inst_bc in bc_contig_combos:
-        inst_combo = '_'.join(sorted(bc_contig_combos[inst_bc]))
-        contig_id_combos.append(inst_combo)
-    ser_combos = pd.Series(contig_id_combos).value_counts()
+    # make dictionary of new clones for each barcode
+    cell_new_clone = dict(zip(barcodes, rank_contig_combos(ser_combos)))
 
-    # number new clones (contig combos) based on abundance
-    inst_id = 1
-    combo_clone_dict = {}
-    for inst_combo in ser_combos.index.tolist():
-        new_clone_name = 'custom-clone-' + str(inst_id)
-        combo_clone_dict[inst_combo] = new_clone_name
-        inst_id = inst_id + 1
+    return cell_new_clone
 
-    # make dictionary of new clones for each barcode
-    cell_new_clone = {}
-    for inst_bc in bc_contig_combos:
-        inst_combo = '_'.join(sorted(bc_contig_combos[inst_bc]))
-        new_clone = combo_clone_dict[inst_combo]
-        cell_new_clone[inst_bc] = new_clone
+def make_custom_clonotypes(inst_df):
+    '''
+    Assign new clones to the barcodes of the merged (across samples)
+    filtered contigs in one pass, equivalent to get_unique_contigs,
+    assign_ids_to_contigs, get_bc_contig_combos, and generate_new_clonotypes.
+    Contigs and barcodes are factorized to integer ids and the sorted contig
+    ids of each barcode are joined to define its contig combo.
+    '''
+    # contig ids are numbered in sorted contig order
+    contig_codes, unique_contigs = pd.factorize(make_contig_keys(inst_df).values, sort=True)
+    bc_codes, barcodes = pd.factorize(inst_df['barcode'].values)
+
+    contig_ids = np.array(['contig-id-' + str(x) for x in range(len(unique_contigs))], dtype=object)
+
+    # sort contigs of each barcode by their id name
+    id_rank = np.empty(len(contig_ids), dtype=np.int64)
+    id_rank[np.argsort(contig_ids.astype(str))] = np.arange(len(contig_ids))
+
+    row_order = np.lexsort((id_rank[contig_codes], bc_codes))
+
+    # join the contig ids of each barcode (rows are grouped by barcode)
+    sorted_ids = contig_ids[contig_codes[row_order]].tolist()
+    bc_starts = np.r_[0, np.flatnonzero(np.diff(bc_codes[row_order])) + 1, len(row_order)].tolist()
+
+    ser_combos = pd.Series(['_'.join(sorted_ids[bc_starts[x]:bc_starts[x + 1]])
+                            for x in range(len(bc_starts) - 1)])
+
+    cell_new_clone = dict(zip(barcodes.tolist(), rank_contig_combos(ser_combos)))
 
     return cell_new_clone
 
-def add_uniform_noise(df_ini):
-    df = deepcopy(df_ini)
-    rows = df.index.tolist()
-    cols = df.columns.tolist()
+def add_uniform_noise(df_ini, chunk_size=10000):
+    rows = df_ini.index.tolist()
+    cols = df_ini.columns.tolist()
 
-    # generate random matrix
-    np.random.seed(99)
-    num_rows = df.shape[0]
-    num_cols = df.shape[1]
-    mat = np.random.rand(num_rows, num_cols)
+    # output (noise is added in place one chunk of rows at a time)
+    mat = df_ini.values.astype(np.float64)
 
-    # make random noise dataframe centered about zero
-    df_noise = pd.DataFrame(data=mat, columns=cols, index=rows).round(2) - 0.5
+    # generate random noise centered about zero (the random stream is the
+    # same as drawing the full matrix at once)
+    random_state = np.random.RandomState(99)
+    for start in range(0, mat.shape[0], chunk_size):
+        stop = min(start + chunk_size, mat.shape[0])
+        mat[start:stop] += np.round(random_state.rand(stop - start, mat.shape[1]), 2) - 0.5
 
-    df_new = df + df_noise
+    df_new = pd.DataFrame(data=mat, columns=cols, index=rows)
 
     return df_new
 
@@ -821,99 +1424,85 @@ def filter_sparse_matrix_by_list(feat, feature_type='gex', keep_rows='all', keep
     '''
     This function filters sparse data by lists of rows/cols.
     filter_by_all_cols is the default because we want all data to have the same number of barcodes/cells
+    Matrices are sliced once (rows and columns together) so that only the
+    selected data is copied, unfiltered matrices are shared with feat.
     '''
 
-    feat_filt = deepcopy(feat)
-
     # get all cols from any feature
-    tmp_feat = list(feat_filt.keys())[0]
-    cols = feat_filt[tmp_feat]['barcodes']
+    tmp_feat = list(feat.keys())[0]
+    cols = feat[tmp_feat]['barcodes']
 
-    # Feature (row) Level Filtering
-    #################################
-    # apply to single feature
+    # Feature (row) Level Filtering (single feature)
+    #################################################
+    rows_idx = None
     if isinstance(keep_rows, list):
+        index_dict = dict((value, idx) for idx,value in enumerate(feat[feature_type]['features']))
+        rows_idx = np.array([index_dict[x] for x in keep_rows], dtype=np.int64)
 
-        # get initial feature list
-        rows_orig = feat_filt[feature_type]['features']
-
-        index_dict = dict((value, idx) for idx,value in enumerate(rows_orig))
-        rows_idx = [index_dict[x] for x in keep_rows]
-
-        # copy feature data of interest
-        inst_mat = deepcopy(feat_filt[feature_type]['mat'])
-        inst_mat = inst_mat[rows_idx,:]
-
-        # filter rows for single feature
-        feat_filt[feature_type]['barcodes'] = cols
-        feat_filt[feature_type]['features'] = keep_rows
-        feat_filt[feature_type]['mat'] = inst_mat
-
-    # Cell (col) Level Filtering
-    #################################
-    # apply to all features
+    # Cell (col) Level Filtering (all features)
+    ############################################
+    cols_idx = None
     if isinstance(keep_cols, list):
         index_dict = dict((value, idx) for idx,value in enumerate(cols))
-        cols_idx = [index_dict[x] for x in keep_cols]
+        cols_idx = np.array([index_dict[x] for x in keep_cols], dtype=np.int64)
 
-        # filter all features by columns
-        for inst_feat in feat:
+    feat_filt = {}
+    for inst_feat in feat:
+        inst_rows_idx = rows_idx if inst_feat == feature_type else None
 
-            # get initial feature list
-            rows_orig = feat_filt[inst_feat]['features']
+        inst_mat = feat[inst_feat]['mat']
+        if inst_rows_idx is not None and cols_idx is not None:
+            inst_mat = inst_mat[inst_rows_idx[:, None], cols_idx]
+        elif inst_rows_idx is not None:
+            inst_mat = inst_mat[inst_rows_idx, :]
+        elif cols_idx is not None:
+            inst_mat = inst_mat[:, cols_idx]
 
-            inst_mat = deepcopy(feat_filt[inst_feat]['mat'])
-            inst_mat = inst_mat[:,cols_idx]
-
-            # filter single feature by columns
-            feat_filt[inst_feat]['barcodes'] = keep_cols
-            feat_filt[inst_feat]['features'] = rows_orig
-            feat_filt[inst_feat]['mat'] = inst_mat
+        feat_filt[inst_feat] = {}
+        feat_filt[inst_feat]['barcodes'] = list(keep_cols if cols_idx is not None else feat[inst_feat]['barcodes'])
+        feat_filt[inst_feat]['features'] = list(keep_rows if inst_rows_idx is not None else feat[inst_feat]['features'])
+        feat_filt[inst_feat]['mat'] = inst_mat
 
     return feat_filt
 
 def preserve_genes_most_variant(input_df, genes_most_variant=500):
     gene_variance = (input_df['gex']['mat'].power(2)).mean(1) - (
         np.power(input_df['gex']['mat'].mean(1), 2))
-    gene_variance_sorted = sorted([(index, variance) for index, variance in enumerate(gene_variance)],
-                                  key=(lambda x: x[1]), reverse=True)
+    gene_variance = np.asarray(gene_variance).ravel()
+
+    # top genes by variance (ties in gene order) without sorting all genes
+    num_keep = min(genes_most_variant, len(gene_variance))
+    if num_keep > 0:
+        top_index = np.argpartition(-gene_variance, num_keep - 1)[:num_keep]
+        top_index = np.flatnonzero(gene_variance >= gene_variance[top_index].min())
+        top_index = top_index[np.lexsort((top_index, -gene_variance[top_index]))][:num_keep]
+    else:
+        top_index = []
+
+    features = input_df['gex']['features']
     feature_data_gene_variance_filtered = filter_sparse_matrix_by_list(input_df,
                                                                           feature_type='gex',
-                                                                          keep_rows=[input_df['gex'][
-                                                                                         'features'][
-                                                                                         each_gene_variance[0]] for
-                                                                                     each_gene_variance in
-                                                                                     gene_variance_sorted[
-                                                                                     :genes_most_variant]])
+                                                                          keep_rows=[features[x] for x in top_index])
 
     return feature_data_gene_variance_filtered
 
-def filter_ribo_mito_from_list(all_genes):
-
-    # find ribosomal genes
-    ribo_rpl = [x for x in all_genes if 'RPL' in x]
-    ribo_rps = [x for x in all_genes if 'RPS' in x]
-    ribo_genes = ribo_rpl + ribo_rps
-
+def filter_ribo_mito_from_list(all_genes, gene_annotation=None):
 
-    # Find mitochondrial genes
-    list_mito_genes = ['MTRNR2L11', 'MTRF1', 'MTRNR2L12', 'MTRNR2L13', 'MTRF1L', 'MTRNR2L6', 'MTRNR2L7',
-                    'MTRNR2L10', 'MTRNR2L8', 'MTRNR2L5', 'MTRNR2L1', 'MTRNR2L3', 'MTRNR2L4']
+    if gene_annotation is None:
+        gene_annotation = make_gene_annotation(all_genes)
 
-    mito_genes = [x for x in all_genes if 'MT-' == x[:3] or
-                 x.split('_')[0] in list_mito_genes]
+    # filter ribosomal (contain RPL or RPS) and mitochondrial genes
+    is_keep = ~(gene_annotation['ribo-list'] | gene_annotation['mito-list'])
 
-
-    # filter genes
-    keep_genes = [x for x in all_genes if x not in ribo_genes]
-    keep_genes = [x for x in keep_genes if x not in mito_genes]
+    all_genes = list(all_genes)
+    keep_genes = [all_genes[x] for x in np.flatnonzero(is_keep)]
 
     return keep_genes
 
 
 def calc_feat_sum_and_unique_count_across_cells(feat_data, inst_feat):
     barcodes = (feat_data[inst_feat]['barcodes'] if 'barcodes' in feat_data[inst_feat].keys() else feat_data[inst_feat].columns)
-    mat = deepcopy(feat_data[inst_feat]['mat'])
+    mat = feat_data[inst_feat]['mat']
 
     # sum umi of measured features
     arr_sum = np.asarray(mat.sum(axis=0))[0]
@@ -923,9 +1512,14 @@ def calc_feat_sum_and_unique_count_across_cells(feat_data, inst_feat):
     ser_sum_ash = np.arcsinh(ser_sum/5)
     ser_sum_ash.name = inst_feat + '-umi-sum-ash'
 
-    # count number of measured features
-    mat[mat > 1] = 1
-    arr_count = np.asarray(mat.sum(axis=0))[0]
+    # count number of measured features (values are capped at one)
+    if mat.getformat() not in ['csc', 'csr']:
+        mat = mat.tocsc()
+    if mat.getformat() == 'csc':
+        col_ids = np.repeat(np.arange(mat.shape[1]), np.diff(mat.indptr))
+    else:
+        col_ids = mat.indices
+    arr_count = np.bincount(col_ids, weights=np.minimum(mat.data, 1), minlength=mat.shape[1])
     ser_count = pd.Series(arr_count, index=barcodes, name=inst_feat + '-num-unique')
 
     inst_df = pd.concat([ser_sum, ser_sum_ash, ser_count], axis=1)
@@ -933,6 +1527,7 @@ def calc_feat_sum_and_unique_count_across_cells(feat_data, inst_feat):
     return inst_df
 
 
+
 def sample_meta(df_meta_ini, sample_name):
     list_index = []
     list_data = []
@@ -973,95 +1568,197 @@ def sample_meta(df_meta_ini, sample_name):
 
     return ser_meta
 
-def merge_lanes(lane_dirs, merge_dir, data_types=['gex', 'adt', 'hto', 'meta_cell'],
-    return_df=True):
+def read_lane_schema(inst_file):
+    '''
+    Read the row labels, column labels (and the names of both indexes), and
+    column dtypes of a lane parquet file without loading its data
+    '''
+    import pyarrow.parquet as pq
 
-    lane_dirs = sorted(lane_dirs)
+    schema = pq.read_schema(inst_file)
+    index_cols = [x for x in schema.pandas_metadata['index_columns'] if isinstance(x, str)]
 
-    if return_df:
-        df = {}
+    df_empty = pd.read_parquet(inst_file, columns=[])
 
-    for inst_type in data_types:
+    lane_schema = {}
+    lane_schema['rows'] = df_empty.index
+    lane_schema['cols_name'] = df_empty.columns.name
+    lane_schema['cols'] = [x for x in schema.names if x not in index_cols]
+    lane_schema['dtypes'] = [schema.field(x).type.to_pandas_dtype() for x in lane_schema['cols']]
 
-        df_merge = None
+    return lane_schema
 
-        print('\n' + inst_type + '\n----------------')
+def merge_lane_matrices(lane_files, merge_file, chunk_size=10000000):
+    '''
+    Merge lane matrices (features x barcodes) column-wise without holding
+    more than one lane in memory. The sorted output is preallocated as a
+    memory-mapped array on disk, filled one lane at a time, and written to
+    parquet in row groups of about chunk_size values. Lanes can not share
+    columns (barcodes).
+    '''
+    import pyarrow as pa
+    import pyarrow.parquet as pq
 
-        # collect data
-        for inst_dir in lane_dirs:
+    # read schemas
+    lane_schemas = {}
+    for inst_lane in lane_files:
+        lane_schemas[inst_lane] = read_lane_schema(lane_files[inst_lane])
+
+    # barcodes found in more than one lane
+    ser_cols = pd.Series([y for x in lane_schemas.values() for y in x['cols']])
+    dup_cols = ser_cols[ser_cols.duplicated()].unique().tolist()
+    if len(dup_cols) > 0:
+        raise ValueError(str(len(dup_cols)) + ' columns are found in more than one lane, e.g. ' +
+                         str(dup_cols[:5]))
+
+    # keep index names if all lanes have the same names (as in pd.concat)
+    rows_names = set([x['rows'].name for x in lane_schemas.values()])
+    cols_names = set([x['cols_name'] for x in lane_schemas.values()])
+
+    all_rows = pd.Index(sorted(set().union(*[x['rows'] for x in lane_schemas.values()])),
+                        name=rows_names.pop() if len(rows_names) == 1 else None)
+    all_cols = pd.Index(sorted(set().union(*[x['cols'] for x in lane_schemas.values()])),
+                        name=cols_names.pop() if len(cols_names) == 1 else None)
+
+    # missing rows are filled with NaN (as in an outer join), which makes
+    # integer columns of lanes with missing rows float
+    col_dtypes = {}
+    for inst_schema in lane_schemas.values():
+        is_missing = len(inst_schema['rows']) < len(all_rows)
+        for inst_col, inst_dtype in zip(inst_schema['cols'], inst_schema['dtypes']):
+            inst_dtype = np.dtype(inst_dtype)
+            if is_missing and inst_dtype.kind in 'biu':
+                inst_dtype = np.dtype(np.float64)
+            col_dtypes[inst_col] = inst_dtype
+
+    has_missing = any(len(x['rows']) < len(all_rows) for x in lane_schemas.values())
+    inst_dtype = np.result_type(*col_dtypes.values())
+    if has_missing and inst_dtype.kind in 'biu':
+        inst_dtype = np.dtype(np.float64)
+    is_mixed = any(x != inst_dtype for x in col_dtypes.values())
+
+    # preallocate
+    mmap_file = merge_file + '.tmp.npy'
+    mat_merge = np.lib.format.open_memmap(mmap_file, mode='w+', dtype=inst_dtype,
+                                          shape=(len(all_rows), len(all_cols)))
+    if has_missing:
+        mat_merge[:] = np.nan
+
+    # fill one lane at a time
+    for inst_lane in lane_files:
+        inst_df = pd.read_parquet(lane_files[inst_lane])
+        print(inst_lane, inst_df.shape)
+
+        row_pos = all_rows.get_indexer(inst_df.index)
+        col_pos = all_cols.get_indexer(inst_df.columns)
+
+        mat_merge[np.ix_(row_pos, col_pos)] = inst_df.values
+        del inst_df
+
+    print('merged', mat_merge.shape)
+
+    # write in row groups
+    chunk_rows = max(1, int(chunk_size / max(1, len(all_cols))))
+    writer = None
+    for start in range(0, len(all_rows), chunk_rows):
+        df_chunk = pd.DataFrame(mat_merge[start:start + chunk_rows], index=all_rows[start:start + chunk_rows],
+                                columns=all_cols)
+        if is_mixed:
+            df_chunk = df_chunk.astype(col_dtypes)
+        table = pa.Table.from_pandas(df_chunk)
+        if writer is None:
+            writer = pq.ParquetWriter(merge_file, table.schema)
+        writer.write_table(table)
+
+    if writer is not None:
+        writer.close()
+
+    del mat_merge
+    os.remove(mmap_file)
+
+def merge_lane_meta(lane_files, merge_file):
+    '''
+    Merge lane metadata (barcodes x categories) row-wise, adding a Lane_10x
+    category
+    '''
+    list_df = []
+    for inst_lane in lane_files:
+        inst_df = pd.read_parquet(lane_files[inst_lane])
+        inst_df['Lane_10x'] = inst_lane
+        print(inst_lane, inst_df.shape)
+        list_df.append(inst_df)
 
-            inst_lane = inst_dir.split('/')[-1]
-            inst_file = inst_dir + '/' + inst_type + '.parquet'
-            if os.path.exists(inst_file):
+    df_merge = pd.concat(list_df, axis=0, sort=True)
+    print('merged', df_merge.shape)
 
-                inst_df = pd.read_parquet(inst_file)
+    # sort columns and rows
+    df_merge = df_merge.loc[sorted(df_merge.index.tolist()), sorted(df_merge.columns.tolist())]
+    df_merge.to_parquet(merge_file)
+
+def merge_lanes(lane_dirs, merge_dir, data_types=['gex', 'adt', 'hto', 'meta_cell'],
+    return_df=True, max_workers=None, chunk_size=10000000):
+    '''
+    Merge the data types of several lanes into sorted parquet files in
+    merge_dir. Data types are merged in parallel threads and matrices are
+    merged out-of-core (see merge_lane_matrices).
+    '''
 
-                # if meta add lane category
-                if 'meta' in inst_type:
-                    ser_lane = pd.Series(data=inst_lane, index=inst_df.index.tolist())
-                    inst_df['Lane_10x'] = ser_lane
+    lane_dirs = sorted(lane_dirs)
 
-                print(inst_lane, inst_df.shape)
+    def merge_type(inst_type):
 
-                # merge on the fly
-                if df_merge is None:
-                    df_merge = deepcopy(inst_df)
-                else:
-                    if 'meta' in inst_type:
-                        df_merge = pd.concat([df_merge, inst_df], axis=0, sort=True)
-                    else:
-                        df_merge = pd.concat([df_merge, inst_df], axis=1)
-                print('df_merge', df_merge.shape)
+        # collect lane files
+        lane_files = {}
+        for inst_dir in lane_dirs:
+            inst_lane = inst_dir.split('/')[-1]
+            inst_file = inst_dir + '/' + inst_type + '.parquet'
+            if os.path.exists(inst_file):
+                lane_files[inst_lane] = inst_file
 
-        print('merged', inst_type, df_merge.shape)
+        print('\n' + inst_type + '\n----------------')
 
-        # sort columns and rows
-        cols = sorted(df_merge.columns.tolist())
-        rows = sorted(df_merge.index.tolist())
-        df_merge = df_merge.loc[rows, cols]
+        merge_file = merge_dir + '/' + inst_type + '.parquet'
+        if 'meta' in inst_type:
+            merge_lane_meta(lane_files, merge_file)
+        else:
+            merge_lane_matrices(lane_files, merge_file, chunk_size=chunk_size)
 
-        df_merge.to_parquet(merge_dir + '/' + inst_type + '.parquet')
+    if max_workers is None:
+        max_workers = len(data_types)
 
-        if return_df:
-            # save to dictionary
-            df[inst_type] = df_merge
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(merge_type, data_types))
 
     if return_df:
+        df = {}
+        for inst_type in data_types:
+            df[inst_type] = pd.read_parquet(merge_dir + '/' + inst_type + '.parquet')
         return df
 
-def load_kb_vel_feature_matrix(inst_path, inst_sample, to_csc=True):
-
-    # Load barcodes
-    #################
-    filename = inst_path + inst_sample + '.barcodes.txt'
-    f = open(filename, 'r')
-    lines = f.readlines()
-    f.close()
-
-    barcodes = []
-    for inst_bc in lines:
-        inst_bc = inst_bc.strip().split('\t')
-
-        barcodes.append(inst_bc[0])
-
+def load_kb_vel_feature_matrix(inst_path, inst_sample, to_csc=True, cache_dir=None):
+    '''
+    Load a kallisto bustools (velocity) matrix as a feature_data dictionary.
+    Optionally, the parsed matrix and labels are saved to (and reloaded from)
+    a binary cache in cache_dir.
+    '''
 
-    # Load genes
-    #################
-    filename = inst_path + inst_sample + '.genes.txt'
-    f = open(filename, 'r')
-    lines = f.readlines()
-    f.close()
+    source_files = [inst_path + inst_sample + x for x in ['.barcodes.txt', '.genes.txt', '.mtx']]
+    params = {'inst_sample': inst_sample}
 
-    genes = []
-    for inst_gene in lines:
-        inst_gene = inst_gene.strip().split('\t')
+    if cache_dir is not None:
+        feature_data = load_feature_data_cache(cache_dir, source_files, params=params)
+        if feature_data is not None:
+            return feature_data
 
-        genes.append(inst_gene[0])
+    # Load barcodes and genes
+    ###########################
+    barcodes = read_tsv_labels(source_files[0])[0].tolist()
+    genes = read_tsv_labels(source_files[1])[0].tolist()
 
-    # Load Matrix
-    #################
-    mat = io.mmread(inst_path + inst_sample +'.mtx').transpose()
-    mat = mat.tocsc()
+    # Load Matrix (barcodes are rows)
+    ####################################
+    mat_size, row, col, data = read_mtx_triplets(source_files[2])
+    mat = csc_matrix((data, (col, row)), shape=(mat_size[1], mat_size[0]))
 
     print(len(genes), len(barcodes), mat.shape)
 
@@ -1071,6 +1768,9 @@ def load_kb_vel_feature_matrix(inst_path, inst_sample, to_csc=True):
     feature_data['gex']['features'] = genes
     feature_data['gex']['barcodes'] = barcodes
 
+    if cache_dir is not None:
+        save_feature_data_cache(feature_data, cache_dir, source_files, params=params)
+
     return feature_data
 
 def drop_debris_gex_hto_ash(df_meta, gex_ash_thresh=None, hto_ash_thresh=None):
@@ -1112,38 +1812,40 @@ def make_ct_list(df_hto, meta_hto):
 
     '''assign cells to debris/singlet/multiplet based on threshold only (ash normalized)'''
 
-    ser_list = []
-    df_hto_tmp = deepcopy(np.arcsinh(df_hto/5))
-
-    for inst_row in df_hto_tmp.index.tolist():
+    arr_ash = np.arcsinh(df_hto.values/5)
 
-        # get data for a HTO
-        inst_ser = deepcopy(df_hto_tmp.loc[inst_row])
+    # load threshold level for each HTO
+    arr_thresh = meta_hto.loc[df_hto.index, 'hto-threshold-ash'].values.astype(float)
 
-        # load threshold level for this HTO
-        inst_thresh = meta_hto.loc[inst_row, 'hto-threshold-ash']
+    # count HTOs above threshold in each cell
+    arr_sum = (arr_ash >= arr_thresh[:, None]).sum(axis=0)
 
-        # binarize HTO values about threshold
-        inst_ser[inst_ser < inst_thresh] = 0
-        inst_ser[inst_ser >= inst_thresh] = 1
+    # find singlets
+    cells = np.asarray(df_hto.columns.tolist(), dtype=object)
+    ct_list = {}
+    ct_list['debris']    = cells[arr_sum == 0].tolist()
+    ct_list['singlet']   = cells[arr_sum == 1].tolist()
+    ct_list['multiplet'] = cells[arr_sum > 1].tolist()
 
-        # assemble list of series to make dataframe later
-        ser_list.append(inst_ser)
+    return ct_list
 
-        # find cells that are positive for this HTO
-        pos_hto = inst_ser[inst_ser==1].index.tolist()
+def calc_hto_top_two(df_hto):
+    '''
+    Highest and second highest HTO value of every cell (column) of df_hto
+    using a partial sort, missing values are only used if a cell has fewer
+    than two measured HTOs
+    '''
+    arr_hto = df_hto.values
+    is_missing = pd.isnull(arr_hto)
+    if is_missing.any():
+        arr_hto = np.where(is_missing, -np.inf, arr_hto.astype(float))
 
-    # generate binarized dataframe
-    df_binary = pd.concat(ser_list, axis=1).transpose()
+    arr_top = np.partition(arr_hto, arr_hto.shape[0] - 2, axis=0)[-2:]
 
-    # find singlets
-    ser_sum = df_binary.sum(axis=0)
-    ct_list = {}
-    ct_list['debris']    = ser_sum[ser_sum == 0].index.tolist()
-    ct_list['singlet']   = ser_sum[ser_sum == 1].index.tolist()
-    ct_list['multiplet'] = ser_sum[ser_sum > 1].index.tolist()
+    if is_missing.any():
+        arr_top = np.where(arr_top == -np.inf, np.nan, arr_top)
 
-    return ct_list
+    return arr_top[1], arr_top[0]
 
 def calc_s2n_and_s2t(df_hto, meta_hto, meta_cell, inf_replace):
 
@@ -1157,48 +1859,30 @@ def calc_s2n_and_s2t(df_hto, meta_hto, meta_cell, inf_replace):
     ser_max_hto = df_hto.idxmax(axis=0)
     meta_cell['hto-max-name'] = ser_max_hto
 
-    list_first = []
-    list_second = []
-    list_thresh = []
-    list_cells = []
-
-    for inst_cell in df_hto.columns.tolist():
-        inst_ser = df_hto[inst_cell].sort_values(ascending=False)
-        inst_first  = inst_ser.get_values()[0]
-        inst_second = inst_ser.get_values()[1]
-
-
-        inst_max_hto_name = ser_max_hto[inst_cell]
-        inst_max_hto_thresh = meta_hto['hto-threshold-umi'][inst_max_hto_name]
-
-        list_first.append(inst_first)
-        list_second.append(inst_second)
-        list_thresh.append(inst_max_hto_thresh)
-        list_cells.append(inst_cell)
+    list_cells = df_hto.columns.tolist()
 
-    ser_first  = pd.Series(data=list_first,  index=list_cells, name='first highest HTO')
-    ser_second = pd.Series(data=list_second, index=list_cells, name='second highest HTO')
-    ser_thresh = pd.Series(data=list_thresh, index=list_cells, name='threshold HTO')
+    arr_first, arr_second = calc_hto_top_two(df_hto)
+    arr_thresh = meta_hto['hto-threshold-umi'].loc[ser_max_hto.values].values
 
-    # df_comp = pd.concat([ser_first, ser_second, ser_thresh], axis=1).transpose()
+    ser_first  = pd.Series(data=arr_first,  index=list_cells, name='first highest HTO')
+    ser_second = pd.Series(data=arr_second, index=list_cells, name='second highest HTO')
+    ser_thresh = pd.Series(data=arr_thresh, index=list_cells, name='threshold HTO')
 
     meta_cell['hto-max-umi'] = ser_first
 
     # calc signal-to-noise
     ###########################
-    # sn_ratio = df_comp.loc['first highest HTO']/df_comp.loc['second highest HTO']
     sn_ratio = ser_first/ser_second
     meta_cell['hto-sn'] = sn_ratio
     # replace infinities with large number
-    sn_ratio = sn_ratio.replace(np.Inf, inf_replace)
+    sn_ratio = sn_ratio.replace(np.inf, inf_replace)
 
     # calc signal-to-threshold
     ###########################
-    # sn_ratio = df_comp.loc['first highest HTO']/df_comp.loc['threshold HTO']
     st_ratio = ser_first/ser_thresh
     meta_cell['hto-st'] = st_ratio
     # replace infinities with large number
-    st_ratio = st_ratio.replace(np.Inf, inf_replace)
+    st_ratio = st_ratio.replace(np.inf, inf_replace)
 
     return meta_cell
 
@@ -1217,7 +1901,7 @@ def assign_htos(df_hto, meta_hto, meta_cell, sn_thresh, inf_replace=1000, perfor
 
     # initialize dehash-thresh: debris/singlet/multiplet based on ct_list
     if 'dehash-thresh' not in meta_cell.columns.tolist():
-        ser_type = pd.Series(np.nan, index=meta_cell.index)
+        ser_type = pd.Series(np.nan, index=meta_cell.index, dtype=object)
         meta_cell['dehash-thresh'] = ser_type
 
     # save dehash-thresh
@@ -1229,56 +1913,39 @@ def assign_htos(df_hto, meta_hto, meta_cell, sn_thresh, inf_replace=1000, perfor
     ######################################################
     meta_cell = calc_s2n_and_s2t(df_hto, meta_hto, meta_cell, inf_replace)
 
+    # sample of the highest HTO of every cell
+    arr_type = meta_cell['dehash-thresh'].values
+    arr_max_sample = meta_hto['Sample'].reindex(meta_cell['hto-max-name'].values).values
+
     # Assign Cells to Samples based on Threshold Alone
     ####################################################
-    list_samples = []
-    for inst_cell in meta_cell.index.tolist():
-
-        inst_type = meta_cell.loc[inst_cell, 'dehash-thresh']
-
-        if inst_type == 'singlet':
-            inst_hto = meta_cell.loc[inst_cell, 'hto-max-name']
-            inst_sample = meta_hto.loc[inst_hto]['Sample']
-        else:
-            inst_sample = 'N.A.'
-
-        list_samples.append(inst_sample)
+    list_samples = np.where(arr_type == 'singlet', arr_max_sample, 'N.A.').tolist()
 
     ser_sample = pd.Series(list_samples, index=meta_cell.index.tolist())
     meta_cell['Sample-thresh'] = ser_sample
 
     if perform_sn_adjustment:
         # Assign Cells to Samples Based on Signal to Noise Adjustment
-        cells = meta_cell.index.tolist()
-        for inst_cell in cells:
-            inst_type = meta_cell.loc[inst_cell, 'dehash-thresh']
-            inst_sn = meta_cell.loc[inst_cell, 'hto-sn']
-            inst_max_hto = meta_cell.loc[inst_cell, 'hto-max-name']
-
-            # change singlet to multiplet if low sn
-            if inst_type == 'singlet':
-                if inst_sn < sn_thresh['singlets']:
-                    # convert to multiplet
-                    meta_cell.loc[inst_cell, 'dehash-thresh-sn'] = 'multiplet'
-                    meta_cell.loc[inst_cell, 'Sample-thresh-sn'] = 'N.A.'
-                else:
-                    meta_cell.loc[inst_cell, 'dehash-thresh-sn'] = 'singlet'
-                    meta_cell.loc[inst_cell, 'Sample-thresh-sn'] = meta_hto.loc[inst_max_hto]['Sample']
-            elif inst_type == 'debris':
-                if inst_sn >= sn_thresh['debris']:
-                    meta_cell.loc[inst_cell, 'dehash-thresh-sn'] = 'singlet'
-                    meta_cell.loc[inst_cell, 'Sample-thresh-sn'] = meta_hto.loc[inst_max_hto]['Sample']
-                else:
-                    meta_cell.loc[inst_cell, 'dehash-thresh-sn'] = 'debris'
-                    meta_cell.loc[inst_cell, 'Sample-thresh-sn'] = 'N.A.'
-            elif inst_type == 'multiplet':
-                if inst_sn >= sn_thresh['multiplets']:
-                    meta_cell.loc[inst_cell, 'dehash-thresh-sn'] = 'singlet'
-                    meta_cell.loc[inst_cell, 'Sample-thresh-sn'] = meta_hto.loc[inst_max_hto]['Sample']
-                else:
-                    meta_cell.loc[inst_cell, 'dehash-thresh-sn'] = 'multiplet'
-                    meta_cell.loc[inst_cell, 'Sample-thresh-sn'] = 'N.A.'
+        arr_sn = meta_cell['hto-sn'].values
+
+        # change singlets to multiplets if low sn, and debris and
+        # multiplets to singlets if high sn
+        is_singlet = np.select([arr_type == 'singlet', arr_type == 'debris', arr_type == 'multiplet'],
+                               [~(arr_sn < sn_thresh['singlets']), arr_sn >= sn_thresh['debris'],
+                                arr_sn >= sn_thresh['multiplets']], default=False)
+
+        arr_sn_type = np.where(is_singlet, 'singlet', np.where(arr_type == 'debris', 'debris', 'multiplet'))
+        arr_sn_sample = np.where(is_singlet, arr_max_sample, 'N.A.')
+
+        # only update cells with a dehash-thresh type
+        has_type = np.isin(arr_type, ['debris', 'singlet', 'multiplet'])
+        for inst_col, inst_values in [('dehash-thresh-sn', arr_sn_type), ('Sample-thresh-sn', arr_sn_sample)]:
+            if inst_col in meta_cell.columns:
+                arr_ini = meta_cell[inst_col].values.astype(object)
+            else:
+                arr_ini = np.full(meta_cell.shape[0], np.nan, dtype=object)
 
+            meta_cell[inst_col] = np.where(has_type, inst_values, arr_ini).tolist()
 
         ser_counts = meta_cell['dehash-thresh-sn'].value_counts()
 
@@ -1,29 +1,43 @@
+import pandas as pd
+import numpy as np
+
 def make_df_from_cols(cols):
-    inst_col = cols[0]
-
-    cat_titles = []
-    for inst_info in inst_col[1:]:
-        inst_title = inst_info.split(': ')[0]
-        cat_titles.append(inst_title)
-
-    clean_cols = []
-    for inst_col in cols:
-        inst_clean = []
-        for inst_info in inst_col:
-            if ': ' in inst_info:
-                inst_clean.append(inst_info.split(': ')[1])
-            else:
-                inst_clean.append(inst_info)
-        clean_cols.append(tuple(inst_clean))
-
-    df_ini = pd.DataFrame(data=clean_cols).set_index(0)
-    mat = df_ini.get_values()
-    rows = df_ini.index.tolist()
-
-    print(mat.shape)
-    print(len(rows))
-    print(len(clean_cols))
-
-    df_meta = pd.DataFrame(data=mat, index=rows, columns=cat_titles)
-
-    return df_meta
\ No newline at end of file
+    '''
+    Convert clustergrammer tuple labels, e.g. (name, 'title: value', ...), to
+    a DataFrame of categories with one column per category title. Each
+    category column is factorized so that every unique label is only decoded
+    once, numeric categories become numbers and categories with repeated
+    values become categoricals.
+    '''
+    df_ini = pd.DataFrame.from_records([x if isinstance(x, tuple) else (x,) for x in cols])
+    rows = df_ini[0].tolist()
+
+    df_meta = pd.DataFrame(index=rows)
+
+    for inst_col in df_ini.columns[1:]:
+        cat_codes, cat_labels = pd.factorize(df_ini[inst_col].values)
+
+        # title is taken from the first label
+        inst_title = str(cat_labels[0]).split(': ')[0]
+
+        # drop the 'title: ' prefix (labels without a title are kept)
+        cat_values = [str(x).split(': ', 1)[1] if ': ' in str(x) else x for x in cat_labels]
+
+        # 'nan' values and missing labels (code -1, e.g. from shorter tuples)
+        # are missing, the remaining values are re-coded
+        is_missing = np.array([x == 'nan' for x in cat_values] + [True])
+        keep_codes = np.cumsum(~is_missing) - 1
+        keep_codes[is_missing] = -1
+        cat_codes = keep_codes[cat_codes]
+        cat_values = [x for x, inst_missing in zip(cat_values, is_missing) if not inst_missing]
+
+        # missing values have code -1 (last element)
+        ser_num = pd.to_numeric(pd.Series(cat_values + [np.nan], dtype=object), errors='coerce')
+        if ser_num[:-1].notnull().all():
+            df_meta[inst_title] = ser_num.values[cat_codes]
+        elif len(cat_values) <= len(rows) / 2 and len(set(cat_values)) == len(cat_values):
+            df_meta[inst_title] = pd.Categorical.from_codes(cat_codes, categories=cat_values)
+        else:
+            df_meta[inst_title] = np.array(cat_values + [np.nan], dtype=object)[cat_codes]
+
+    return df_meta